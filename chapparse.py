@@ -138,21 +138,27 @@ Options:
     -h, --help
         This help file""" % (name,version))
 
+def rounddiv(n,d):
+    # n/d rounded to the nearest integer (ties to even), integers only
+    q, r = divmod(n,d)
+    return q + (2*r > d or 2*r == d and q % 2)
+
 def time2ms(ts):
+    # HH:MM:SS.mmm, with any number of decimals
     
     t = ts.split(':')
-    h = int(t[0]) * 3600000
-    m = h + int(t[1]) * 60000
-    ms = round(m + float(t[2]) * 1000)
+    s, _, frac = t[2].partition('.')
+    ms = ((int(t[0]) * 60 + int(t[1])) * 60 + int(s)) * 1000
+    if frac:
+        ms += rounddiv(int(frac) * 1000, 10 ** len(frac))
     
     return ms
 
 def ms2frame(ms,fps):
     
-    s = ms / 1000
     fps = rat.search(fps).groups() if rat.search(fps) else \
         [re.search('(\d+)',fps).group(0),'1']
-    frame = round((int(fps[0])/int(fps[1])) * s)
+    frame = rounddiv(ms * int(fps[0]), int(fps[1]) * 1000)
     
     return frame
 
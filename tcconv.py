@@ -1,16 +1,156 @@
 #!/usr/bin/env python3
 
-from sys import argv
+from sys import argv, exit
 try:
-    from vfr import parse_tc
+    from vfr import convert_tc
 except ImportError:
     exit("tcconv requires vfr.py in order to work")
 
-if len(argv) >= 4:
-    fps = argv[1]
-    tc = argv[2]
-    frames = int(argv[3])
-    first = int(argv[4]) if len(argv) == 5 else 0
-    parse_tc(fps, frames, tc, first)
-else:
-    exit("tcconv.py <fps/v1 timecodes> <output v2 timecodes> <frames> [<first>]")
+usage = """%prog <fps/v1 timecodes> <output v2 timecodes> <frames> [<first>]
+       %prog --v1 <timecodes> <output v1 timecodes> [<frames>]
+       %prog --batch -f FRAMES [options] <v1 timecodes, dirs or globs>..."""
+
+
+def convert(job):
+    """Converts a (input, output, frames, first, tolerance) job.
+
+    Returns the input, output, timestamps written, seconds taken and the
+    error message (None if it worked).
+
+    """
+    from time import perf_counter
+    tcfile, otc, frames, first, tolerance = job
+    start = perf_counter()
+    written, error = 0, None
+    try:
+        written = convert_tc(tcfile, frames, otc, first, tolerance)
+        if written is None:
+            written, error = 0, 'not v1 timecodes'
+    except SystemExit as e:
+        error = str(e.code)
+    except Exception as e:
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    return tcfile, otc, written, perf_counter() - start, error
+
+
+def tolerance(o):
+    """Returns the tolerance passed to convert_tc (None for v2 output)."""
+    return o.tolerance if o.v1 else None
+
+
+def inputs(paths, pattern):
+    """Expands files, directories (their files matching pattern) and globs.
+    """
+    from glob import glob
+    from os.path import isdir, isfile, join
+    files = []
+    for path in paths:
+        if isdir(path):
+            files.extend(sorted(f for f in glob(join(path, pattern))
+                                if isfile(f)))
+        elif isfile(path):
+            files.append(path)
+        else:
+            files.extend(sorted(f for f in glob(path) if isfile(f)))
+    return files
+
+
+def batch(o, paths):
+    """Converts many timecodes files over a pool of o.jobs processes."""
+    from os.path import basename, dirname, join, splitext, abspath
+    from time import perf_counter
+
+    jobs = []
+    for tcfile in inputs(paths, o.pattern):
+        if tcfile.endswith(o.suffix):
+            continue
+        name = splitext(basename(tcfile))[0] + o.suffix
+        otc = join(o.outdir or dirname(tcfile), name)
+        if abspath(otc) != abspath(tcfile):
+            jobs.append((tcfile, otc, o.frames, o.first, tolerance(o)))
+    if not jobs:
+        exit("No timecodes files found")
+
+    start = perf_counter()
+    total = 0
+    failed = []
+    if o.jobs > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(o.jobs, len(jobs)))
+        results = pool.imap_unordered(convert, jobs)
+    else:
+        pool = None
+        results = map(convert, jobs)
+    try:
+        for tcfile, otc, written, elapsed, error in results:
+            if error:
+                failed.append(tcfile)
+                print('{0}: {1}'.format(tcfile, error))
+                continue
+            total += written
+            print('{0} -> {1}: {2:d} frames in {3:.3f}s ({4:.0f} fps)'.format(
+                  tcfile, otc, written, elapsed, written / elapsed
+                  if elapsed else 0))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    elapsed = perf_counter() - start
+    print('\nConverted {0:d} of {1:d} files, {2:d} frames in {3:.2f}s '
+          '({4:.0f} fps)'.format(len(jobs) - len(failed), len(jobs), total,
+                                 elapsed, total / elapsed if elapsed else 0))
+    if failed:
+        exit('Failed: {0}'.format(', '.join(failed)))
+
+
+def main(args):
+    from optparse import OptionParser
+    from os import cpu_count
+    p = OptionParser(usage=usage)
+    p.add_option('--batch', '-b', action="store_true",
+                 help="Convert every input (files, directories or globs) to "
+                 "a v2 (or --v1) timecodes file")
+    p.add_option('--v1', action="store_true",
+                 help="Write v1 timecodes, merging the runs of frames at a "
+                 "constant frame rate (v2 input needs no frames)")
+    p.add_option('--tolerance', type="float", default=1,
+                 help="Largest difference (ms) allowed between the --v1 "
+                 "timestamps and the input ones. Default: %default")
+    p.add_option('--frames', '-f', type="int", default=0,
+                 help="Number of frames of each --batch output")
+    p.add_option('--first', type="int", default=0,
+                 help="First frame written by --batch. Default: 0")
+    p.add_option('--outdir', '-o',
+                 help="Directory for the --batch outputs. Default: next to "
+                 "each input")
+    p.add_option('--suffix',
+                 help="Replaces the extension of each input in its output "
+                 "name. Default: .v2.txt (.v1.txt with --v1)")
+    p.add_option('--pattern', default='*.txt',
+                 help="Files taken from input directories. Default: %default")
+    p.add_option('--jobs', '-j', type="int", default=cpu_count() or 1,
+                 help="Number of processes used by --batch. Default: "
+                 "%default")
+    (o, a) = p.parse_args(args)
+
+    if o.v1 and o.first:
+        p.error("--first can't be used with --v1")
+    if o.batch:
+        if not (o.frames or o.v1) or not a:
+            p.error("--batch needs --frames and at least one input")
+        if o.suffix is None:
+            o.suffix = '.v1.txt' if o.v1 else '.v2.txt'
+        return batch(o, a)
+    if o.v1:
+        if not 2 <= len(a) <= 3:
+            p.error("--v1 needs an input and an output")
+        return convert_tc(a[0], int(a[2]) if len(a) == 3 else 0, a[1], 0,
+                          o.tolerance)
+    if not 3 <= len(a) <= 4:
+        exit("tcconv.py <fps/v1 timecodes> <output v2 timecodes> <frames> "
+             "[<first>]")
+    convert_tc(a[0], int(a[2]), a[1], int(a[3]) if len(a) == 4 else 0)
+
+
+if __name__ == '__main__':
+    main(argv[1:])
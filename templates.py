@@ -2,6 +2,10 @@
 
 from __future__ import unicode_literals
 from io import open
+from vfr import LRUCache, cache_limit, stage
+
+# Parsed template files, shared by the jobs of a vfr.py --batch or --serve run
+template_cache = LRUCache(cache_limit)
 
 class AutoMKVChapters:
     class Template:
@@ -104,64 +108,125 @@ class AutoMKVChapters:
             else:
                 ofps = str(self.ofps)
 
-            Trims2, Trims2ts = parse_trims(avs, fps, ofps, label=label, clip=clip)[2:4]
+            with stage('connect_with_vfr'):
+                Trims2, Trims2ts = parse_trims(avs, fps, ofps, label=label, clip=clip)[2:4]
             Trims2ts = [(fmt_time(i[0]),fmt_time(i[1]) if i[1] != 0 else None) for i in Trims2ts]
 
             self.trims = Trims2ts
             self.kframes = Trims2
 
-        def parse_mkv(self, path):
-            """Parse a Matroska file for SegmentUID and Duration"""
+        @staticmethod
+        def parse_mkv(path):
+            """Parse a Matroska file for SegmentUID and Duration (ns)
+
+            Walks the EBML elements (EBML header, Segment, SeekHead, Info)
+            instead of searching for their IDs, so only the few hundred
+            bytes holding them are read. Stops at the first Cluster.
+
+            """
             import binascii
             import struct
-            
-            def get_data_len(byte):
-                """Get the length (bytes) of the element data"""
-                n = ord(byte)
+            from mmap import mmap, ACCESS_READ
+
+            def read_vint(pos, keep_marker=False):
+                """Read an EBML variable size integer at pos.
+                Returns (value, next position); value is None if the size is
+                unknown (all ones)."""
+                first = ord(mm[pos:pos + 1])
+                length = 1
                 mask = 0b10000000
-                while not n & mask:
+                while length <= 8 and not first & mask:
                     mask >>= 1
-                return n & ~mask
-            
-            suid = tcscale = duration = 0
+                    length += 1
+                if length > 8:
+                    raise ValueError('invalid EBML integer')
+                value = first if keep_marker else first & (mask - 1)
+                for byte in bytearray(mm[pos + 1:pos + length]):
+                    value = (value << 8) | byte
+                if not keep_marker and value == (1 << (7 * length)) - 1:
+                    value = None
+                return value, pos + length
+
+            def elements(pos, end):
+                """Yield (id, data position, data size) for each element
+                between pos and end."""
+                while pos < end:
+                    eid, pos = read_vint(pos, True)
+                    size, pos = read_vint(pos)
+                    yield eid, pos, size
+                    if size is None:
+                        return
+                    pos += size
+
+            EBML, SEGMENT = 0x1A45DFA3, 0x18538067
+            SEEKHEAD, SEEK, SEEKID, SEEKPOS = 0x114D9B74, 0x4DBB, 0x53AB, 0x53AC
+            INFO, CLUSTER = 0x1549A966, 0x1F43B675
+            SUID, TCSCALE, DURATION = 0x73A4, 0x2AD7B1, 0x4489
+
+            suid = duration = 0
+            tcscale = 1000000
             with open(path, 'rb') as file:
-                if file.read(4) != b'\x1A\x45\xDF\xA3': # not a Matroska file
+                try:
+                    mm = mmap(file.fileno(), 0, access=ACCESS_READ)
+                except ValueError: # empty file
                     return suid, duration
-                chunk_size = 100000 # 100 kB
-                i = 0
-                while True:
-                    if suid and tcscale and duration:
+            try:
+                if mm[:4] != b'\x1A\x45\xDF\xA3': # not a Matroska file
+                    return suid, duration
+                size = len(mm)
+                segment = None
+                for eid, pos, esize in elements(0, size):
+                    if eid == SEGMENT:
+                        segment = pos, size if esize is None else min(pos + esize, size)
+                        break
+                    elif eid != EBML or esize is None:
                         break
-                    bin = file.read(chunk_size)
-                    if not bin:
+                if not segment:
+                    return suid, duration
+
+                info = None # (data position, data size) of Info
+                for eid, pos, esize in elements(*segment):
+                    if eid == INFO:
+                        info = pos, esize
                         break
-                    suid_pos = bin.find(b'\x73\xA4\x90') # \x90 -> 16 bytes
-                    if suid_pos != -1:
-                        suid_pos = 4 + i * chunk_size + suid_pos + 3
-                        file.seek(suid_pos)
-                        suid = binascii.hexlify(file.read(16)).decode()
-                    tcscale_pos = bin.find(b'\x2A\xD7\xB1')
-                    if tcscale_pos != -1:
-                        tcscale_pos = 4 + i * chunk_size + tcscale_pos + 3
-                        file.seek(tcscale_pos)
-                        tcscale_len = get_data_len(file.read(1))
-                        tcscale = int(binascii.hexlify(file.read(tcscale_len)), 16)
-                    duration_pos = bin.find(b'\x44\x89\x84') # float (4 bytes)
-                    if duration_pos != -1:
-                        duration_pos = 4 + i * chunk_size + duration_pos + 3
-                        file.seek(duration_pos)
-                        duration = struct.unpack('>f', file.read(4))[0]
-                    if not duration: # double (8 bytes)
-                        duration_pos = bin.find(b'\x44\x89\x88')
-                        if duration_pos != -1:
-                            duration_pos = 4 + i * chunk_size + duration_pos + 3
-                            file.seek(duration_pos)
-                            duration = struct.unpack('>d', file.read(8))[0]
-                    if bin.find(b'\x1F\x43\xB6\x75') != -1:
-                        # segment info should be before the clusters
+                    elif eid == SEEKHEAD:
+                        for sid, spos, ssize in elements(pos, pos + esize):
+                            if sid != SEEK:
+                                continue
+                            target = offset = None
+                            for cid, cpos, csize in elements(spos, spos + ssize):
+                                if cid == SEEKID:
+                                    target = int(binascii.hexlify(mm[cpos:cpos + csize]), 16)
+                                elif cid == SEEKPOS:
+                                    offset = int(binascii.hexlify(mm[cpos:cpos + csize]), 16)
+                            if (target == INFO and offset is not None and
+                                    segment[0] + offset < size):
+                                iid, ipos, isize = next(elements(segment[0] + offset, size))
+                                if iid == INFO:
+                                    info = ipos, isize
+                        if info is not None:
+                            break
+                    elif eid == CLUSTER or esize is None:
                         break
-                    i += 1
-            duration = duration * tcscale / 1000000
+                if info is None:
+                    return suid, duration
+
+                pos, esize = info
+                raw_duration = 0
+                end = size if esize is None else min(pos + esize, size)
+                for eid, cpos, csize in elements(pos, end):
+                    if eid == SUID and csize == 16:
+                        suid = binascii.hexlify(mm[cpos:cpos + 16]).decode()
+                    elif eid == TCSCALE:
+                        tcscale = int(binascii.hexlify(mm[cpos:cpos + csize]), 16)
+                    elif eid == DURATION and csize in (4, 8):
+                        raw_duration = struct.unpack('>f' if csize == 4 else '>d',
+                                                     mm[cpos:cpos + csize])[0]
+            except (ValueError, TypeError, StopIteration, struct.error):
+                return suid, duration
+            finally:
+                mm.close()
+            duration = round(raw_duration * tcscale)
             return suid, duration
 
         class Edition:
@@ -186,33 +251,38 @@ class AutoMKVChapters:
 
     def __init__(self, templatefile, output=None, avs=None, trims=None,
                  kframes=None, uid=None, label=None, ifps=None, clip=None,
-                 idr=False):
+                 idr=False, libraries=None):
         try:
             import configparser
         except ImportError:
             import ConfigParser as configparser
         from io import open
+        from os.path import getmtime
 
-        # Init config
-        config = configparser.ConfigParser()
-        template = open(templatefile, encoding='utf-8')
+        # Init config (reusing it if this template was already read)
+        key = (templatefile, getmtime(templatefile))
+        config = template_cache.get(key)
+        if not config:
+            config = configparser.ConfigParser()
+            template = open(templatefile, encoding='utf-8')
 
-        # Read template
-        config.readfp(template)
-        template.close()
+            # Read template
+            with stage('read_template'):
+                config.readfp(template)
+            template.close()
+            template_cache[key] = config
 
         # Template defaults
         self = self.Template()
         self.editions = []
         self.uid = uid if uid else self.uid
 
-        # Set mkvinfo path
-        from vfr import mkvmerge, parse_with_mkvmerge, fmt_time
-        from os.path import dirname, join, isfile
+        from vfr import fmt_time
+        from os.path import dirname, isfile
 
-        # Set placeholder for mkvinfo output
-        mkv_globbed = False
-        mkvinfo = {}
+        # Directories searched for segment UIDs
+        mkvdirs = ['.'] + ([dirname(avs) or '.'] if avs else []) + (libraries or [])
+        segments = None
 
         for k, v in config.items('info'):
             if k == 'lang':
@@ -298,43 +368,141 @@ class AutoMKVChapters:
                 if ch.chapter and not (ch.start and ch.end):
                     ch.start, ch.end = self.trims[ch.chapter-1] if self.trims else (ch.start, ch.end)
                 elif ch.suid:
-                    mkvfiles = []
-                    if isfile(ch.suid):
-                        mkvfiles = [ch.suid]
-                    elif not mkv_globbed:
-                        from glob import glob
-                        mkvfiles = glob('*.mkv') + glob(join(dirname(avs),'*.mkv'))
-                        mkv_globbed = True
-                    if mkvfiles:
-                        if parse_with_mkvmerge:
-                            from subprocess import check_output
-                            import json
-                            for file in mkvfiles:
-                                info = check_output([mkvmerge, '-i', '-F', 'json',
-                                    '--output-charset', 'utf-8', file]).decode('utf-8')
-                                try:
-                                    props = json.loads(info).get("container", {}).get("properties", {})
-                                    ch.suid = props.get("segment_uid", 0)
-                                    duration = props.get("duration", 0)
-                                    mkvinfo[ch.suid] = {'file': file,
-                                        'duration': fmt_time(duration * 10**6)
-                                                    if duration else 0}
-                                except Exception:
-                                    pass
+                    with stage('segments'):
+                        segments = segments or SegmentIndex.shared()
+                        if isfile(ch.suid):
+                            ch.suid, duration = segments.file(ch.suid)
                         else:
-                            for file in mkvfiles:
-                                ch.suid, duration = self.parse_mkv(file)
-                                mkvinfo[ch.suid] = {'file': file, 
-                                    'duration': fmt_time(duration * 10**6) 
-                                                if duration else 0}
+                            for mkvdir in mkvdirs:
+                                segments.scan(mkvdir)
+                            found = segments.find(ch.suid)
+                            duration = found[1] if found else 0
                     if not (ch.start or ch.end):
                         ch.start = fmt_time(0) if not ch.start else ch.start
-                        ch.end = mkvinfo[ch.suid]['duration'] if not ch.end and (ch.suid in mkvinfo) else ch.end
+                        ch.end = fmt_time(duration) if duration else ch.end
 
                 ed.chapters.append(ch)
             self.editions.append(ed)
+        if segments:
+            with stage('segments'):
+                segments.save()
         if output:
-            self.toxml(output)
+            with stage('toxml'):
+                self.toxml(output)
+
+
+class SegmentIndex(object):
+    """Index of the segment UIDs and durations (ns) of .mkv files.
+
+    Kept on disk between runs (vfr/segments.json in the user's cache
+    directory); a file is only parsed again if its size or mtime changed.
+    The files kept in memory are bounded by limit (a vfr.CacheLimit).
+
+    """
+
+    shared_index = None
+
+    def __init__(self, path=None, limit=None):
+        import json
+        from os.path import join, isfile
+        from vfr import user_cache_dir
+        self.path = path or join(user_cache_dir(), 'segments.json')
+        self.files = LRUCache(limit, self.dropped)
+        self.by_suid = {}
+        self.scanned = set()
+        self.dirty = False
+        if isfile(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    for path, entry in json.load(f).items():
+                        self.files[path] = entry
+            except ValueError:
+                pass
+        for path, entry in self.files.items():
+            if entry['suid']:
+                self.by_suid.setdefault(entry['suid'], set()).add(path)
+
+    @classmethod
+    def shared(cls):
+        """Returns the index used by every template in this process."""
+        if not cls.shared_index:
+            cls.shared_index = cls(limit=cache_limit)
+        return cls.shared_index
+
+    def dropped(self, path, entry):
+        """Forgets a file dropped from memory; its directory is scanned again
+        when needed."""
+        from os.path import dirname
+        paths = self.by_suid.get(entry['suid'])
+        if paths:
+            paths.discard(path)
+            if not paths:
+                del self.by_suid[entry['suid']]
+        self.scanned.discard(dirname(path))
+
+    def parse(self, path):
+        from vfr import identify, parse_with_mkvmerge
+        if parse_with_mkvmerge:
+            try:
+                props = identify(path).get("container", {}).get("properties", {})
+            except Exception:
+                return 0, 0
+            return props.get("segment_uid", 0), props.get("duration", 0)
+        return AutoMKVChapters.Template.parse_mkv(path)
+
+    def file(self, path):
+        """Returns (suid, duration) of a file, parsing it if it changed."""
+        from os import stat
+        from os.path import abspath
+        path = abspath(path)
+        st = stat(path)
+        entry = self.files.get(path)
+        if not entry or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime_ns:
+            suid, duration = self.parse(path)
+            entry = {'size': st.st_size, 'mtime': st.st_mtime_ns,
+                     'suid': suid, 'duration': duration}
+            self.files[path] = entry
+            self.dirty = True
+        if entry['suid']:
+            self.by_suid.setdefault(entry['suid'], set()).add(path)
+        return entry['suid'], entry['duration']
+
+    def scan(self, directory):
+        """Brings the index up to date with every .mkv in directory."""
+        from glob import glob, escape
+        from os.path import abspath, dirname, isfile, join
+        directory = abspath(directory)
+        if directory in self.scanned:
+            return
+        self.scanned.add(directory)
+        for path in glob(join(escape(directory), '*.mkv')):
+            try:
+                self.file(path)
+            except (IOError, OSError):
+                pass
+        for path in [k for k in self.files if dirname(k) == directory and
+                     not isfile(k)]:
+            del self.files[path]
+            self.dirty = True
+
+    def find(self, suid):
+        """Returns (path, duration) of the file with this segment UID among
+        the scanned directories, or None."""
+        from os.path import dirname
+        for path in sorted(self.by_suid.get(suid, ())):
+            entry = self.files.get(path)
+            if (entry and entry['suid'] == suid and
+                    dirname(path) in self.scanned):
+                return path, entry['duration']
+
+    def save(self):
+        from vfr import save_json, readonly
+        if self.dirty and not readonly:
+            try:
+                save_json(self.path, self.files.dict())
+            except (IOError, OSError):
+                pass
+            self.dirty = False
 
 
 def main(args):
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""Benchmarks for the timestamp hot paths of vfr.py.
+
+Generates synthetic cfr, v1 and v2 timecodes and avisynth scripts in a
+temporary directory, times each case (best of --repeat runs) and measures
+its peak memory with tracemalloc in one extra run. Exits with an error if
+lazily parsing v2 timecodes is slower than reading the whole file.
+
+    bench.py -o baseline.json
+    bench.py --compare baseline.json
+
+"""
+
+import json
+import platform
+import tracemalloc
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+from sys import path, exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+import vfr
+from vfr import (parse_tc, get_ts, convert_v1_to_v2, convert_fps,
+                 convert_frames, parse_avs, parse_trims, fmt_time,
+                 write_qpfile)
+from templates import AutoMKVChapters as amkvc
+
+# Frame durations (ns) of the two rates alternated by the vfr sources
+durations = (41708333, 33366667)
+section = 1000
+
+
+def write_v1(name, n):
+    """v1 timecodes of n frames, 23.976 and 29.97 fps every section frames.
+    """
+    with open(name, 'w') as tc:
+        tc.write('# timecode format v1\nAssume 29.970030\n')
+        for fn in range(0, n, 2 * section):
+            tc.write('{0},{1},23.976024\n'.format(fn,
+                                                   min(fn + section, n) - 1))
+
+
+def write_ivtc(name, n):
+    """v1 timecodes of n frames with an override every 5 frames, cycling
+    through a few rates, like the output of a decimation pass."""
+    rates = ('29.970030', '19.980020', '59.940060')
+    with open(name, 'w') as tc:
+        tc.write('# timecode format v1\nAssume 23.976024\n')
+        tc.writelines('{0},{1},{2}\n'.format(fn, min(fn + 2, n - 1),
+                                             rates[fn // 5 % len(rates)])
+                      for fn in range(0, n, 5))
+
+
+def write_v2(name, n):
+    """v2 timecodes of n frames, with the same rates as write_v1."""
+    with open(name, 'w') as tc:
+        tc.write('# timecode format v2\n')
+        ts = 0
+        lines = []
+        for fn in range(n):
+            lines.append('{0:.6f}\n'.format(ts / 10 ** 6))
+            ts += durations[fn // section % 2]
+            if len(lines) == 2 ** 16:
+                tc.writelines(lines)
+                lines = []
+        tc.writelines(lines)
+
+
+def trim_line(k, n, clip=None, comment=''):
+    """One spliced line of k trims spread over n frames."""
+    call = '{0}.Trim({{0}},{{1}})'.format(clip) if clip else 'Trim({0},{1})'
+    step = max(n // k, 2)
+    return '++'.join(call.format(i * step, i * step + step // 2)
+                     for i in range(k)) + comment
+
+
+def write_avs(name, lines):
+    with open(name, 'w') as avs:
+        avs.write('\n'.join(lines) + '\n')
+    return name
+
+
+def chapters(Trims2, Trims2ts, output):
+    """Writes Matroska chapters the way vfr.py -c file.xml does."""
+    tmp = amkvc.Template()
+    tmp.trims = [(fmt_time(i[0]), fmt_time(i[1]) if i[1] else None)
+                 for i in Trims2ts]
+    tmp.kframes = Trims2
+    ed = tmp.Edition()
+    ed.default = 1
+    ed.num_chapters = len(Trims2ts)
+    ed.uid = cuid = 100
+    ed.chapters = []
+    for i, (start, end) in enumerate(tmp.trims):
+        ch = tmp.Chapter()
+        cuid += 1
+        ch.uid = cuid
+        ch.name = ['Chapter {0:02d}'.format(i + 1)]
+        ch.start, ch.end = start, end
+        ed.chapters.append(ch)
+    tmp.editions = [ed]
+    tmp.toxml(output)
+
+
+def cases(tmp, sizes, trim_counts):
+    """Yields (name, function) for every benchmark."""
+    cfr = '30000/1001'
+    # Time the .tcidx sidecars of v2 timecodes too
+    vfr.index_v2 = True
+    ofps = parse_tc('24000/1001')[0]
+    for n in sizes:
+        v1 = join(tmp, 'v1-{0}.txt'.format(n))
+        v2 = join(tmp, 'v2-{0}.txt'.format(n))
+        ivtc = join(tmp, 'ivtc-{0}.txt'.format(n))
+        write_v1(v1, n)
+        write_v2(v2, n)
+        write_ivtc(ivtc, n)
+        with open(v1) as tc:
+            v1_lines = tc.readlines()[2:]
+        sample = range(0, n, max(n // 100000, 1))
+
+        for kind, src in (('cfr', cfr), ('v1', v1), ('v1-ivtc', ivtc),
+                          ('v2', v2)):
+            def parse(src=src, n=n):
+                vfr.tc_cache.clear()
+                parse_tc(src, n)
+            yield 'parse_tc/{0}/{1}'.format(kind, n), parse
+            if kind != 'cfr':
+                def parse_text(src=src, n=n):
+                    vfr.use_tcidx = False
+                    try:
+                        parse(src, n)
+                    finally:
+                        vfr.use_tcidx = True
+                yield 'parse_tc/{0}-text/{1}'.format(kind, n), parse_text
+            if kind == 'v2':
+                def parse_eager(src=src):
+                    with open(src) as tc:
+                        tc.readlines()
+                yield 'parse_tc/v2-eager/{0}'.format(n), parse_eager
+
+            tc = parse_tc(src, n)[0]
+            def lookup(tc=tc):
+                for fn in sample:
+                    get_ts(fn, tc)
+            yield 'get_ts/{0}/{1}'.format(kind, n), lookup
+
+        yield ('convert_v1_to_v2/{0}'.format(n),
+               lambda n=n: convert_v1_to_v2(v1_lines, n, '29.970030'))
+        timestamps = [fn * durations[0] for fn in sample]
+        def fmt(timestamps=timestamps):
+            for ts in timestamps:
+                fmt_time(ts)
+        yield 'fmt_time/{0}'.format(n), fmt
+
+    n = max(sizes)
+    v2 = join(tmp, 'v2-{0}.txt'.format(n))
+    tc = parse_tc(v2, n)[0]
+    for k in trim_counts:
+        avs = write_avs(join(tmp, 'trims-{0}.avs'.format(k)),
+                        [trim_line(k, n)])
+        yield ('parse_avs/{0}'.format(k), lambda avs=avs: parse_avs(avs))
+        for kind, src in (('cfr', cfr), ('v2', v2)):
+            yield ('parse_trims/{0}/{1}'.format(kind, k),
+                   lambda avs=avs, src=src: parse_trims(avs, src))
+        Trims2, Trims2ts = parse_trims(avs, v2)[2:4]
+        yield ('convert_fps/{0}'.format(k),
+               lambda t=Trims2: convert_fps(t, tc, ofps))
+        fns = [j for i in Trims2 for j in i]
+        yield ('convert_frames/{0}'.format(k),
+               lambda fns=fns: convert_frames(fns, tc, ofps))
+        qpfile = join(tmp, 'trims-{0}.qp'.format(k))
+        yield ('write_qpfile/{0}'.format(k),
+               lambda t=Trims2: write_qpfile(qpfile, list(t)))
+        output = join(tmp, 'trims-{0}'.format(k))
+        yield ('toxml/{0}'.format(k),
+               lambda t=Trims2, ts=Trims2ts: chapters(t, ts, output))
+
+    # Scripts where the wanted line is hard to reach
+    k = max(trim_counts)
+    data = ['# {0:08d} '.format(i) + 'f' * 200 for i in range(200000)]
+    for name, lines, kwargs in (
+            ('clip', [trim_line(k, n), trim_line(k, n, 'src')],
+             {'clip': 'src'}),
+            ('label', [trim_line(k, n, comment=' # ed'),
+                       trim_line(k, n, comment=' # op')], {'label': 'op'}),
+            ('reverse', [trim_line(k, n)] * 20, {'reverse': True}),
+            ('forward-inline', [trim_line(10, n)] + data, {}),
+            ('reverse-inline', data + [trim_line(10, n)], {'reverse': True}),
+            ('line-inline', data + [trim_line(10, n)],
+             {'line_number': len(data) + 1})):
+        avs = write_avs(join(tmp, name + '.avs'), lines)
+        yield ('parse_avs/{0}'.format(name),
+               lambda avs=avs, kwargs=kwargs: parse_avs(avs, **kwargs))
+
+
+def measure(function, repeat):
+    """Returns the best time (s) of repeat runs and the peak memory (bytes)
+    of one more."""
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def compare(results, baseline, threshold, min_time=0.001, min_peak=2 ** 16):
+    """Prints results against baseline and returns the regressed names.
+
+    Times under min_time and peaks under min_peak are too noisy to count.
+
+    """
+    regressions = []
+    print('\n{0:<36} {1:>10} {2:>10} {3:>8} {4:>8}'.format(
+          'case', 'base ms', 'now ms', 'time', 'memory'))
+    for name, now in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        dt = now['time'] / base['time'] - 1 if base['time'] else 0
+        dm = now['peak'] / base['peak'] - 1 if base['peak'] else 0
+        slow = dt > threshold and now['time'] > min_time
+        fat = dm > threshold and now['peak'] > min_peak
+        print('{0:<36} {1:>10.2f} {2:>10.2f} {3:>+7.0%} {4:>+7.0%}{5}'.format(
+              name, base['time'] * 1000, now['time'] * 1000, dt, dm,
+              ' <-' if slow or fat else ''))
+        if slow or fat:
+            regressions.append(name)
+    return regressions
+
+
+def lazy_regressions(results, min_time=0.001):
+    """Returns the lazily parsed v2 cases slower than reading the whole file
+    eagerly, as vfr.py did before LazyTimeline.
+
+    Times under min_time are too noisy to count.
+
+    """
+    slower = []
+    for name, now in sorted(results.items()):
+        eager = results.get(name.replace('/v2-text/', '/v2-eager/'))
+        if ('/v2-text/' in name and eager and now['time'] > eager['time'] and
+                now['time'] > min_time):
+            slower.append(name)
+    return slower
+
+
+def main():
+    p = OptionParser(usage='%prog [options]', description=__doc__.split(
+                     '\n\n')[0])
+    p.add_option('--output', '-o', help='Write the results to this JSON file')
+    p.add_option('--compare', '-c',
+                 help='Baseline JSON to compare against; exits with an error '
+                 'on regressions')
+    p.add_option('--threshold', '-t', type='float', default=0.2,
+                 help='Allowed slowdown/memory growth. Default: 0.2 (20%)')
+    p.add_option('--sizes', default='10000,100000,1000000',
+                 help='Frame counts of the timecodes (up to 10000000). '
+                 'Default: %default')
+    p.add_option('--trims', default='1,100,10000',
+                 help='Trim counts of the scripts. Default: %default')
+    p.add_option('--repeat', '-r', type='int', default=3,
+                 help='Timed runs per case. Default: %default')
+    p.add_option('--filter', '-k', help='Only run cases containing this')
+    o = p.parse_args()[0]
+
+    sizes = [int(i) for i in o.sizes.split(',')]
+    trim_counts = [int(i) for i in o.trims.split(',')]
+    results = {}
+    with TemporaryDirectory(prefix='vfrbench') as tmp:
+        for name, function in cases(tmp, sizes, trim_counts):
+            if o.filter and o.filter not in name:
+                continue
+            elapsed, peak = measure(function, o.repeat)
+            results[name] = {'time': elapsed, 'peak': peak}
+            print('{0:<36} {1:>10.2f} ms {2:>10.1f} KiB'.format(
+                  name, elapsed * 1000, peak / 1024))
+
+    if o.output:
+        with open(o.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=1, sort_keys=True)
+    slower = lazy_regressions(results)
+    if slower:
+        exit('Slower than the eager v2 parsing: {0}'.format(', '.join(slower)))
+    if o.compare:
+        with open(o.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, o.threshold)
+        if regressions:
+            exit('{0} regression(s) over {1:.0%}: {2}'.format(
+                 len(regressions), o.threshold, ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
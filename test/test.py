@@ -3,7 +3,10 @@
 from subprocess import check_output,CalledProcessError
 from re import search
 from os import rename, unlink
-from os.path import isfile, join as pjoin
+from os.path import isfile, join as pjoin, abspath
+from glob import glob
+from sys import path
+from tempfile import TemporaryDirectory
 
 args = [
         r'-i audio.flac -vf 24000/1001 test.avs --test',
@@ -18,32 +21,355 @@ args = [
         r'-f 24/1.001 -c chap-fps-{}.xml -n chnames.txt --uid 123456 test.avs',
         r'-f tc1-cfr.txt -c chap-cfr-{}.xml -t amkvc.mod.txt --uid 123456 test.avs'
         ]
-stable = check_output('git tag',shell=True).decode()[:-1].split('\n')[-1]
-current = search('^\* (\w+)(?m)',check_output("git branch",shell=True).decode()[:-1]).group(1)
-
-check_output('git show {0}:vfr.py > vfr.py'.format(stable), shell=True)
-check_output('git show {0}:templates.py > templates.py'.format(stable), shell=True)
-try:
-    old = [check_output(r'python vfr.py ' + command.format('old'), shell=True) for command in args]
-    new = [check_output(r'python {0} {1}'.format(pjoin('..', 'vfr.py'), command.format('new')), shell=True) for command in args]
-    fails = []
-    for i in range(len(old)):
-        if old[i] != new[i]:
-            fails.append(args[i])
-    chapters = [[f.format('old'),f.format('new')] for f in ['chap-fps-{}.txt','chap-cfr-{}.txt','chap-fps-{}.xml','chap-cfr-{}.xml','chap-cfr-{}tags.xml','chap-cfr-{}.qpfile']]
-    for f in chapters:
-        with open(f[0],'rb') as oldf:
-            with open(f[1],'rb') as newf:
-                old = oldf.readlines()
-                new = newf.readlines()
-                if old != new:
-                    fails.append('{0} and {1} are not identical.'.format(f[0],f[1]))
-    if len(fails) != 0:
-        print('Failed:')
-        [print(i) for i in fails]
-    else:
-        print('All tests passed.')
+
+# Checks of the current version's functions, which have no stable output to
+# compare with. Each one returns an error message, or None if it passed.
+
+def ebml(eid, payload):
+    """An EBML element with an 8 byte size."""
+    return eid + b'\x01' + len(payload).to_bytes(7, 'big') + payload
+
+def check_parse_mkv():
+    """SegmentUID and Duration from a direct Info or one found by SeekHead."""
+    from struct import pack
+    from templates import AutoMKVChapters
+    INFO = b'\x15\x49\xa9\x66'
+    info = ebml(INFO, ebml(b'\x73\xa4', bytes(range(16))) +
+                ebml(b'\x2a\xd7\xb1', pack('>I', 1000000)) +
+                ebml(b'\x44\x89', pack('>d', 1500.0)))
+    header = ebml(b'\x1a\x45\xdf\xa3', ebml(b'\x42\x82', b'matroska'))
+    def seekhead(offset):
+        return ebml(b'\x11\x4d\x9b\x74', ebml(b'\x4d\xbb', ebml(b'\x53\xab',
+                    INFO) + ebml(b'\x53\xac', pack('>Q', offset))))
+    void = ebml(b'\xec', bytes(10))
+    layouts = {'direct': info,
+               'seekhead': seekhead(len(seekhead(0)) + len(void)) + void + info}
+    with TemporaryDirectory() as tmp:
+        for name, segment in layouts.items():
+            mkv = pjoin(tmp, name + '.mkv')
+            with open(mkv, 'wb') as f:
+                f.write(header + ebml(b'\x18\x53\x80\x67', segment))
+            found = AutoMKVChapters.Template.parse_mkv(mkv)
+            if found != ('000102030405060708090a0b0c0d0e0f', 1500000000):
+                return '{0}: {1}'.format(name, found)
+        # Duration cut off by the end of the file
+        mkv = pjoin(tmp, 'truncated.mkv')
+        with open(mkv, 'wb') as f:
+            f.write((header + ebml(b'\x18\x53\x80\x67', info))[:-4])
+        found = AutoMKVChapters.Template.parse_mkv(mkv)
+        if found != ('000102030405060708090a0b0c0d0e0f', 0):
+            return 'truncated: {0}'.format(found)
+
+def check_test_mode_caches():
+    """--test writes no caches, not even the index of the .mkv of a
+    template's suid, which a normal run saves."""
+    from os import environ
+    from struct import pack
+    info = ebml(b'\x15\x49\xa9\x66', ebml(b'\x73\xa4', bytes(range(16))) +
+                ebml(b'\x44\x89', pack('>d', 1500.0)))
+    with TemporaryDirectory() as tmp:
+        with open(pjoin(tmp, 'ext.mkv'), 'wb') as f:
+            f.write(ebml(b'\x1a\x45\xdf\xa3', ebml(b'\x42\x82', b'matroska')) +
+                    ebml(b'\x18\x53\x80\x67', info))
+        with open(pjoin(tmp, 'template.txt'), 'w') as f:
+            f.write('[info]\neditions=1\n[edition1]\nchapters=2\n'
+                    '1name=Part\n1chapter=1\n2name=Ext\n2suid=ext.mkv\n')
+        with open(pjoin(tmp, 'a.avs'), 'w') as f:
+            f.write('Trim(0,99)\n')
+        env = dict(environ, XDG_CACHE_HOME=pjoin(tmp, 'cache'))
+        env.pop('LOCALAPPDATA', None)
+        segments = pjoin(tmp, 'cache', 'vfr', 'segments.json')
+        for test in (['--test'], []):
+            check_output(['python', abspath(pjoin('..', 'vfr.py')), '-f',
+                          '24/1.001', '-t', 'template.txt', '-c', 'ch.xml',
+                          'a.avs'] + test, cwd=tmp, env=env)
+            if isfile(segments) != (not test):
+                return '{0} written: {1}'.format(segments, isfile(segments))
+
+# Runs of options the stable version may not have, checked against the files
+# in expected/ ({0} is the output directory)
+expected = [
+        r'-f 24/1.001 --labels trim,test -c {0}/labels.txt -n chnames.txt test.avs',
+        r'-f tc1-vfr.txt --clips clipX,clipB,clipC -c {0}/clips.txt test.avs',
+        r'-f 30/1.001 --clips clipY,clip_cenas -c {0}/clips-30.txt -q {0}/clips.qpf test.avs',
+        r'-f tc1-vfr.txt --ofps 30/1.001 -c {0}/ofps-30.txt -q {0}/ofps-30.qpf test.avs',
+        r'-f tc1-vfr.txt --ofps 24/1.001 -c {0}/ofps-24.txt -q {0}/ofps-24.qpf test.avs',
+        r'-f tc1-vfr.txt --ofps tc2-vfr.txt -c {0}/ofps-tc2.txt -q {0}/ofps-tc2.qpf test.avs'
+        ]
+
+def check_expected():
+    """--labels, --clips and --ofps with vfr give the files in expected/."""
+    from os import listdir
+    with TemporaryDirectory() as tmp:
+        for command in expected:
+            check_output('python {0} {1}'.format(pjoin('..', 'vfr.py'),
+                         command.format(tmp)), shell=True)
+        names = sorted(listdir(tmp))
+        if names != sorted(listdir('expected')):
+            return 'files written: {0}'.format(', '.join(names))
+        for name in names:
+            with open(pjoin(tmp, name), 'rb') as f, \
+                    open(pjoin('expected', name), 'rb') as g:
+                if f.read() != g.read():
+                    return '{0} differs'.format(name)
+
+def check_v1_round_trip():
+    """v1 -> v2 -> v1 -> v2 at --tolerance 0 gives the same v2 timecodes."""
+    from vfr import convert_tc
+    with TemporaryDirectory() as tmp:
+        for src in ('tc1-vfr.txt', 'test2.vfr.txt', '24000/1001'):
+            v2, v1, again = [pjoin(tmp, f) for f in ('v2.txt', 'v1.txt', 'again.txt')]
+            convert_tc(src, 40000, v2)
+            convert_tc(v2, 0, v1, tolerance=0)
+            convert_tc(v1, 40000, again)
+            with open(v2, 'rb') as f, open(again, 'rb') as g:
+                if f.read() != g.read():
+                    return '{0} changed'.format(src)
+
+def check_vfr_ofps():
+    """Trims of a vfr source convert with --ofps like those of a cfr source
+    at the rate around them, whatever the first frame's duration, and short
+    v2 --ofps timecodes like their rate."""
+    from vfr import trims_tc, offset_trims
+    with TemporaryDirectory() as tmp:
+        tc = pjoin(tmp, 'tc.txt')
+        with open(tc, 'w') as f:
+            f.write('# timecode format v1\nAssume 30\n0,29,120\n')
+        v2 = pjoin(tmp, 'ofps.txt')
+        with open(v2, 'w') as f:
+            f.write('# timecode format v2\n')
+            f.writelines('{0}\n'.format(ms) for ms in range(0, 1000, 20))
+        for ofps in ('50', '24000/1001', '60', v2):
+            converted = []
+            for fps, trims in ((tc, [[60, 89], [120, 179], [200, 0]]),
+                               ('30', [[30, 59], [90, 149], [170, 0]])):
+                tcs, frames, ofpstc = trims_tc(trims, fps, ofps)
+                converted.append(offset_trims(trims, tcs, frames, ofpstc)[2:4])
+            if converted[0] != converted[1]:
+                return '{0}: {1} != {2}'.format(ofps, *converted)
+            if ofps == '50':
+                at_50 = converted[0]
+        if converted[0] != at_50:
+            return 'v2 50fps: {0} != {1}'.format(converted[0], at_50)
+
+def check_convert_frames():
+    """convert_frames maps a whole list of frames like convert_fps does one
+    frame, or trim, at a time."""
+    from random import Random
+    from vfr import parse_tc, convert_frames, convert_fps
+    rand = Random(5)
+    for fps, ofps in (('30000/1001', '24000/1001'), ('tc2-cfr.txt', '25'),
+                      ('tc2-vfr.txt', '30000/1001'),
+                      ('tc2-vfr.txt', 'tc2-cfr.txt'),
+                      ('60000/1001', 'tc2-vfr.txt')):
+        old = parse_tc(fps, 50000)[0]
+        new = parse_tc(ofps, 50000)[0]
+        # Apart enough that no two frames map to the same one
+        fns = sorted(rand.sample(range(0, 40000, 5), 200))
+        mapped = convert_frames(fns, old, new)[0]
+        if mapped != [convert_fps([[fn]], old, new)[0] for fn in fns]:
+            return '{0} to {1}: frames differ'.format(fps, ofps)
+        # Adjacent trims, where the collision rules apply
+        cuts = sorted(rand.sample(range(1, 40000), 100))
+        trims = [[a, b - 1] for a, b in zip([0] + cuts, cuts)]
+        flat = [j for i in convert_fps(trims, old, new) for j in i]
+        if convert_frames([j for i in trims for j in i], old, new)[0] != flat:
+            return '{0} to {1}: trims differ'.format(fps, ofps)
+
+def check_pcm_cut():
+    """WAV, RF64 and W64 are cut natively, padded with silence for a
+    positive delay and trimmed for a negative one."""
+    from struct import pack
+    from vfr import PCMAudio, split_audio
+    rate, n = 8000, 16000
+    samples = b''.join(pack('<h', i % 30000 - 15000) for i in range(n))
+    # Trims at 0.5-1 s and from 1.5 s to the end
+    trims = ['00:00:00.500', '00:00:01.000', '00:00:01.500']
+    with TemporaryDirectory() as tmp:
+        wav = pjoin(tmp, 'in.wav')
+        fmt = pack('<HHIIHH', 1, 1, rate, rate * 2, 2, 16)
+        with open(wav, 'wb') as f:
+            f.write(b'RIFF' + pack('<I', 36 + 2 * n) + b'WAVE' + b'fmt ' +
+                    pack('<I', 16) + fmt + b'data' + pack('<I', 2 * n) +
+                    samples)
+        inputs = {'wav': wav}
+        src = PCMAudio(wav)
+        for kind in ('rf64', 'w64'):
+            src.kind = kind
+            header, pad = src.header(len(samples))
+            inputs[kind] = pjoin(tmp, 'in.' + kind)
+            with open(inputs[kind], 'wb') as f:
+                f.write(header + samples + b'\0' * pad)
+        for kind, name in sorted(inputs.items()):
+            for delay in (0, 750, -300):
+                expected = b''
+                for a, b in ((4000, 8000), (12000, n)):
+                    a -= delay * rate // 1000
+                    b -= delay * rate // 1000 if b != n else 0
+                    expected += (b'\0' * 2 * max(-a, 0) +
+                                 samples[2 * max(a, 0):2 * b])
+                out = pjoin(tmp, 'out.{0}.{1:d}'.format(kind, delay))
+                split_audio(list(trims), name, out,
+                            str(delay) if delay else None)
+                cut = PCMAudio(out)
+                with open(out, 'rb') as f:
+                    data = f.read()
+                if (cut.kind != kind or data[cut.data_offset:cut.data_offset +
+                        cut.data_size] != expected):
+                    return '{0} with delay {1:d}'.format(kind, delay)
+
+def check_cut_scheduler():
+    """--batch cuts run at most audio_processes at a time, a warning (exit
+    code 1) is only printed and a failure (2) fails its own job alone."""
+    from contextlib import redirect_stdout
+    from io import StringIO
+    from os import chmod
+    from sys import executable
+    import vfr
+    with TemporaryDirectory() as tmp:
+        stub = pjoin(tmp, 'mkvmerge')
+        with open(stub, 'w') as f:
+            f.write('#!{0}\n'.format(executable) + '''
+import sys, os, time, glob
+if '--identify' in sys.argv:
+    sys.exit(print('{}'))
+running = os.path.join(os.path.dirname(sys.argv[0]), 'running')
+mine = '{0}.{1:d}'.format(running, os.getpid())
+open(mine, 'w').close()
+with open(mine + '.seen', 'w') as f:
+    f.write(str(len(glob.glob(running + '.*[0-9]'))))
+time.sleep(0.3)
+os.remove(mine)
+out = sys.argv[sys.argv.index('-o') + 1]
+sys.exit(int(os.path.basename(out)[4]))
+''')
+        chmod(stub, 0o755)
+        avs = pjoin(tmp, 'a.avs')
+        with open(avs, 'w') as f:
+            f.write('Trim(0,99)++Trim(200,299)\n')
+        audio = pjoin(tmp, 'a.flac')
+        open(audio, 'w').close()
+        # The stub exits with the digit after 'exit' in the output's name
+        codes = [0, 2, 1, 0, 0]
+        jobs = [(i, ['-i', audio, '-o', pjoin(tmp, 'exit{0:d}-{1:d}.mka'
+                     .format(code, i)), '-f', '24000/1001', avs])
+                for i, code in enumerate(codes)]
+        mkvmerge, cache = vfr.mkvmerge, vfr.identify_cache_file
+        vfr.mkvmerge, vfr.identify_cache_file = stub, pjoin(tmp, 'id.json')
+        try:
+            with redirect_stdout(StringIO()) as printed:
+                errors = vfr.run_jobs(jobs, audio_processes=2)
+        finally:
+            vfr.mkvmerge, vfr.identify_cache_file = mkvmerge, cache
+        seen = []
+        for name in glob(pjoin(tmp, 'running.*.seen')):
+            with open(name) as f:
+                seen.append(int(f.read()))
+    if len(seen) != len(codes) or max(seen) > 2:
+        return 'concurrent cuts: {0}'.format(seen)
+    if errors != [(i, 'Failed to execute mkvmerge: 2' if code == 2 else None)
+                  for i, code in enumerate(codes)]:
+        return 'errors: {0}'.format(errors)
+    if printed.getvalue().count('Mkvmerge exited with warnings: 1') != 1:
+        return 'no warning for exit code 1'
+
+def check_split_command():
+    """Several inputs are cut by one mkvmerge command, each with the --sync
+    of its own delay (-d or DELAY in its name) on its audio and subtitles."""
+    from contextlib import redirect_stdout
+    from io import StringIO
+    from os import stat
+    import vfr
+    tracks = {'video.mkv': [(0, 'video'), (1, 'audio'), (2, 'subtitles')],
+              'audio DELAY -120ms.aac': [(0, 'audio')],
+              'audio DELAY 40ms.ac3': [(0, 'audio')],
+              'audio.flac': [(0, 'audio')]}
+    with TemporaryDirectory() as tmp:
+        inputs = [pjoin(tmp, name) for name in tracks]
+        for name in inputs:
+            open(name, 'w').close()
+        # identify results for the empty files, without running mkvmerge
+        loaded, readonly = vfr.identify_loaded, vfr.readonly
+        vfr.identify_loaded, vfr.readonly = True, True
+        try:
+            for name, found in zip(inputs, tracks.values()):
+                st = stat(name)
+                vfr.identify_cache[abspath(name)] = {
+                    'size': st.st_size, 'mtime': st.st_mtime_ns,
+                    'info': {'container': {'properties': {}}, 'tracks': [
+                        {'id': i, 'type': t, 'properties': {}}
+                        for i, t in found]}}
+            out = pjoin(tmp, 'out.mka')
+            with redirect_stdout(StringIO()) as printed:
+                vfr.split_audio(['00:00:01.000', '00:00:02.000'], inputs, out,
+                                ['250', None, '-80'], verbose=True, test=True,
+                                tracks=['audio', 'subtitles'])
+        finally:
+            vfr.identify_loaded, vfr.readonly = loaded, readonly
+            for name in inputs:
+                if abspath(name) in vfr.identify_cache:
+                    vfr.identify_cache.pop(abspath(name))
+    expected = [vfr.mkvmerge, '-o', out,
+                '-D', '--sync', '1:250', '--sync', '2:250', inputs[0],
+                '-D', '--sync', '0:-120', inputs[1],
+                '-D', '--sync', '0:-80', inputs[2],
+                '-D', inputs[3],
+                '--split', 'parts:00:00:01.000-00:00:02.000']
+    expected = 'Cutting: {0}'.format(' '.join('"{0}"'.format(i)
+                                              for i in expected))
+    if printed.getvalue().strip() != expected:
+        return printed.getvalue().strip()
+
+checks = [check_expected, check_parse_mkv, check_test_mode_caches,
+          check_v1_round_trip, check_vfr_ofps, check_convert_frames, check_pcm_cut,
+          check_cut_scheduler, check_split_command]
+
+# .tcidx sidecars written by the checks and runs below are removed at the end
+sidecars = set(glob('*.tcidx'))
+
+fails = []
+path.insert(0, abspath('..'))
+for check in checks:
+    try:
+        error = check()
+    except (Exception, SystemExit) as e:
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    if error:
+        fails.append('{0}: {1}'.format(check.__name__, error))
+del path[0]
+
+stable = check_output('git tag',shell=True).decode().split()
+stable = stable[-1] if stable else None
+
+if not stable:
+    print('No stable tag to compare with, only running the checks.')
+else:
+    check_output('git show {0}:vfr.py > vfr.py'.format(stable), shell=True)
+    check_output('git show {0}:templates.py > templates.py'.format(stable), shell=True)
+    try:
+        old = [check_output(r'python vfr.py ' + command.format('old'), shell=True) for command in args]
+        new = [check_output(r'python {0} {1}'.format(pjoin('..', 'vfr.py'), command.format('new')), shell=True) for command in args]
+        for i in range(len(old)):
+            if old[i] != new[i]:
+                fails.append(args[i])
+        chapters = [[f.format('old'),f.format('new')] for f in ['chap-fps-{}.txt','chap-cfr-{}.txt','chap-fps-{}.xml','chap-cfr-{}.xml','chap-cfr-{}tags.xml','chap-cfr-{}.qpfile']]
+        for f in chapters:
+            with open(f[0],'rb') as oldf:
+                with open(f[1],'rb') as newf:
+                    old = oldf.readlines()
+                    new = newf.readlines()
+                    if old != new:
+                        fails.append('{0} and {1} are not identical.'.format(f[0],f[1]))
+    except CalledProcessError as e:
+        fails.append('{0} exited with {1}'.format(e.cmd, e.returncode))
+
+[unlink(f) for f in set(glob('*.tcidx')) - sidecars]
+
+if len(fails) != 0:
+    print('Failed:')
+    [print(i) for i in fails]
+else:
+    print('All tests passed.')
+    if stable:
         f += ['vfr.py','templates.py']
         [[unlink(ff) for ff in f] for f in chapters]
-except CalledProcessError:
-    pass
@@ -2,12 +2,21 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
-from sys import exit, argv
+from sys import exit, argv, modules, byteorder
 from re import compile
-from os.path import isfile, splitext
+from os.path import (isfile, splitext, getmtime, join, basename, exists,
+                     dirname, abspath)
+from struct import Struct
 from math import floor, ceil
 from fractions import Fraction
+from functools import lru_cache
 from io import open
+from array import array
+from bisect import bisect_right
+from itertools import islice
+from copy import copy
+from contextlib import contextmanager, nullcontext
+from locale import getpreferredencoding
 
 exts = {
     "xml": "MKV",
@@ -15,15 +24,191 @@ exts = {
 }
 default_fps = "30000/1001"
 
+cfr_re = compile('(\d+(?:\.\d+)?)(?:/|:)?(\d+(?:\.\d+)?)?')
+vfr_re = compile('# time(?:code|stamp) format (v1|v2)')
+# .tcidx sidecar: magic, format version, kind (1: v1, 2: v2), source size,
+# source mtime (ns), number of int64 values following, source blake2b digest
+tcidx_header = Struct('<8sHBxQqQ16s12x')
+tcidx_magic = b'VFRTCIDX'
+# NTSC rates correct_to_ntsc snaps to (from FFMS2), in the order they're
+# tried: (rate compared to, distance below which it's snapped, result)
+ntsc_rates = tuple((rate, (fps - fps / 1.001) / 2.0, Fraction(result))
+                   for fps in (24, 25, 30, 48, 50, 60, 100, 120)
+                   for rate, result in ((fps, fps),
+                                        (fps / 1.001, Fraction(fps * 1000,
+                                                               1001)))
+                   if rate == fps or fps % 25)
+trim_re = compile(r'(?i)\b(?:(\w+)\s*\.\s*)?(trim)\s*\(\s*(?:([a-z_]\w*)\s*,\s*)?'
+                  r'(\d+)\s*,\s*(-?\d+)\s*\)')
+
 # Change the paths here if the programs aren't in your $PATH
 mkvmerge = r'mkvmerge'
 
+# Where mkvmerge --identify results are kept between runs
+# (None: vfr/identify.json in the user's cache directory)
+identify_cache_file = None
+
+# Keep a binary .tcidx sidecar next to each v1 timecodes file parsed (and v2
+# ones with --index-timecodes), so later runs map it instead of parsing the
+# text again
+use_tcidx = True
+
 # Check to utilize mkvtoolnix for obtaining the uid and duration of the mkv
 # files specified on templates, instead of letting this script parse them
 # directly (faster).  Just in case the later fails.
 parse_with_mkvmerge = False
 
-def main(args):
+def nbytes(obj, seen=None):
+    """Rough memory footprint of obj and everything it holds, in bytes."""
+    from sys import getsizeof
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(nbytes(k, seen) + nbytes(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(nbytes(i, seen) for i in obj)
+    if hasattr(obj, '__dict__'):
+        size += nbytes(obj.__dict__, seen)
+    return size
+
+
+class CacheLimit(object):
+    """Memory cap in bytes shared by several LRUCaches (see nbytes).
+
+    Once their entries add up to more than maxsize, the least recently used
+    entry of any of them is dropped. Unbounded while maxsize is None.
+
+    """
+
+    def __init__(self, maxsize=None):
+        from itertools import count
+        self.maxsize = maxsize
+        self.caches = []
+        self.clock = count()
+
+    def size(self):
+        return sum(cache.size for cache in self.caches)
+
+    def trim(self, keep=None):
+        """Drops entries until the caches fit in maxsize, except keep (the
+        newest one) or the last one left."""
+        size = self.size()
+        while self.maxsize is not None and size > self.maxsize:
+            oldest = [(cache.used[key], cache, key) for cache in self.caches
+                      for key in islice(cache.entries, 2)
+                      if (cache, key) != keep]
+            if not oldest:
+                break
+            used, cache, key = min(oldest, key=lambda i: i[0])
+            size -= cache.sizes[key]
+            cache.drop(key)
+
+
+class LRUCache(object):
+    """Dict-like cache dropping its least recently used entries when the
+    caches sharing its CacheLimit go over it.
+
+    on_drop(key, value) is called for the entries dropped that way.
+
+    """
+
+    def __init__(self, limit=None, on_drop=None):
+        from collections import OrderedDict
+        self.limit = limit or CacheLimit()
+        self.limit.caches.append(self)
+        self.on_drop = on_drop
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.used = {}
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __getitem__(self, key):
+        self.entries.move_to_end(key)
+        self.used[key] = next(self.limit.clock)
+        return self.entries[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self.entries else default
+
+    def keys(self):
+        return list(self.entries)
+
+    def items(self):
+        return list(self.entries.items())
+
+    def dict(self):
+        """Returns the entries as a plain dict (without using them)."""
+        return dict(self.entries)
+
+    def __setitem__(self, key, value):
+        if key in self.entries:
+            self.pop(key)
+        self.entries[key] = value
+        self.used[key] = next(self.limit.clock)
+        self.sizes[key] = (nbytes(key) + nbytes(value)
+                           if self.limit.maxsize is not None else 0)
+        self.size += self.sizes[key]
+        self.limit.trim((self, key))
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key):
+        self.size -= self.sizes.pop(key)
+        del self.used[key]
+        return self.entries.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.used.clear()
+        self.size = 0
+
+    def drop(self, key):
+        """Removes key to make room, telling on_drop."""
+        value = self.pop(key)
+        if self.on_drop:
+            self.on_drop(key, value)
+
+
+# Memory shared by the caches kept between jobs (see serve())
+cache_limit = CacheLimit()
+
+# Parsed timecodes files, shared by the jobs of a --batch or --serve run
+tc_cache = LRUCache(cache_limit)
+
+# Set during --batch so split_audio queues its cuts instead of waiting for them
+audio_scheduler = None
+
+# Set by --profile (see Profiler and stage())
+profiler = None
+
+# Set by --test: no caches or .tcidx sidecars are written
+readonly = False
+
+# Set by --index-timecodes: v2 timecodes get a .tcidx sidecar too (see read_tc)
+index_v2 = False
+
+# See identify()
+identify_cache = LRUCache(cache_limit)
+identify_loaded = False
+identify_refresh = False
+identify_refreshed = set()
+identify_stats = {'hits': 0, 'misses': 0}
+
+def option_parser():
     from optparse import OptionParser
     p = OptionParser(description='Grabs avisynth trims and outputs chapter '
                      'file, qpfile and/or cuts audio (works with cfr and '
@@ -38,16 +223,33 @@ def main(args):
                  "Trim(ClipX,0,100). Default: any trim")
     p.add_option('--line', '-g', action="store", type="int", dest="line",
                  help="Specify directly the line used")
-    p.add_option('--input', '-i', action="store", help='Audio file to be cut',
-                 dest="input")
+    p.add_option('--labels', action="store", dest="labels",
+                 help="Comma separated LABELs whose trims are all taken from "
+                 "a single read of the script, each writing its own outputs "
+                 "(named by {label} or with .LABEL before the extension)")
+    p.add_option('--clips', action="store", dest="clips",
+                 help="Same as --labels but for clips")
+    p.add_option('--input', '-i', action="append",
+                 help='Audio file to be cut (can be used more than once to '
+                 'cut several files into --output at once)', dest="input")
+    p.add_option('--tracks', action="store",
+                 help="Comma separated track types kept from each --input "
+                 "(audio, subtitles, video). Default: all", dest="tracks")
     p.add_option('--output', '-o', action="store",
                  help='Cut audio from MKVMerge', dest="output")
     p.add_option('--fps', '-f', action="store",
                  help='Frames per second or Timecodes file', dest="fps")
-    p.add_option('--ofps', action="store", help='Output frames per second',
+    p.add_option('--ofps', action="store", help='Output frames per second or timecodes file',
                  dest="ofps")
     p.add_option('--timecodes', action="store", help='Output v2 timecodes',
                  dest="otc")
+    p.add_option('--timecodes-v1', action="store_true", dest="otc_v1",
+                 help="Write --timecodes as v1 timecodes, merging the runs "
+                 "of frames at a constant frame rate")
+    p.add_option('--tolerance', action="store", type="float", default=1,
+                 help="Largest difference (ms) allowed between the "
+                 "timestamps of --timecodes-v1 and the input ones. "
+                 "Default: %default")
     p.add_option('--chapters', '-c', action="store",
                  help='Chapters file [.{0}/.txt]'.format("/.".join(
                  exts.keys())), dest="chapters")
@@ -58,6 +260,10 @@ def main(args):
                  help="Template file for chapters", dest="template")
     p.add_option('--uid', action="store",
                  help="Base UID for --template or --chnames", dest="uid")
+    p.add_option('--library', action="append",
+                 help="Extra directory with .mkv files searched for the "
+                 "segment UIDs of --template (can be used more than once)",
+                 dest="library")
     p.add_option('--qpfile', '-q', action="store", help='QPFile for x264',
                  dest="qpfile")
     p.add_option('--verbose', '-v', action="store_true", help='Verbose',
@@ -66,8 +272,9 @@ def main(args):
                  dest="merge")
     p.add_option('--remove', '-r', action="store_true",
                  help='Remove cut files', dest="remove")
-    p.add_option('--delay', '-d', action="store",
-                 help="Set delay of audio (can be negative)", dest="delay")
+    p.add_option('--delay', '-d', action="append",
+                 help="Set delay of audio (can be negative); once per "
+                 "--input, in the same order", dest="delay")
     p.add_option('--reverse', '-b', action="store_true",
                  help="Reverse parsing of .avs", dest="reverse")
     p.add_option('--test', action="store_true",
@@ -78,8 +285,61 @@ def main(args):
     p.add_option('--sbr', action="store_true",
                  help="Set this if inputting an .aac and it's SBR/HE-AAC",
                  dest="sbr")
+    p.add_option('--index-timecodes', action="store_true",
+                 help="Also keep a .tcidx sidecar for v2 timecodes (--fps), "
+                 "so later runs don't read their text", dest="index_tc")
+    p.add_option('--refresh-cache', action="store_true",
+                 help="Discard cached mkvmerge --identify results",
+                 dest="refresh_cache")
+    p.add_option('--batch', action="store",
+                 help="JSON manifest with a list of jobs to run in a single "
+                 "process, each taking the same options as the command line",
+                 dest="batch")
+    p.add_option('--jobs', '-j', action="store", type="int", default=1,
+                 help="Number of processes used by --batch", dest="jobs")
+    p.add_option('--audio-jobs', action="store", type="int", default=2,
+                 help="Number of mkvmerge processes cutting audio at once "
+                 "(per --jobs process) in --batch", dest="audio_jobs")
+    p.add_option('--profile', action="store_const", const="table",
+                 help="Print the time, CPU time and peak memory of each stage "
+                 "and call counts of hot functions to stderr (slower)",
+                 dest="profile")
+    p.add_option('--profile-json', action="store_const", const="json",
+                 help="Same as --profile but as JSON", dest="profile")
+    p.add_option('--serve', action="store",
+                 help="Run as a daemon taking JSON jobs on the Unix domain "
+                 "socket SERVE", dest="serve")
+    p.add_option('--cache-size', action="store", type="int", default=256,
+                 help="Memory cap in MiB for the timecodes and templates kept "
+                 "by --serve. Default: 256", dest="cache_size")
+    return p
+
+
+def main(args, outdir=None):
+    """Runs vfr.py with command line args.
+
+    Chapters, qpfiles and output timecodes go to outdir instead, if set.
+    Returns a list with the trims of each label (see write_outputs).
+
+    """
+    p = option_parser()
     (o, a) = p.parse_args(args)
 
+    if o.profile and not profiler:
+        return profiled(o.profile, main, args, outdir)
+    # Set for each run, as --batch and --serve go through here for every job
+    global identify_refresh, readonly, index_v2
+    identify_refresh, readonly = o.refresh_cache, o.test
+    index_v2 = o.index_tc
+    identify_refreshed.clear()
+    if o.batch:
+        return run_batch(o.batch, o.jobs, o.audio_jobs, o.refresh_cache)
+    if o.serve:
+        if o.refresh_cache:
+            global identify_loaded
+            identify_loaded = True
+            identify_cache.clear()
+        return serve(o.serve, o.cache_size * 2 ** 20)
     if len(a) < 1:
         p.error("No avisynth script specified.")
     if not o.fps:
@@ -90,7 +350,7 @@ def main(args):
 
     #Determine chapter type
     if o.chapters:
-        chre = compile("\.({0})$(?i)".format("|".join(exts.keys())))
+        chre = compile("(?i)\.({0})$".format("|".join(exts.keys())))
         ret = chre.search(o.chapters)
         chapter_type = exts[ret.group(1).lower()] if ret else "OGM"
     else:
@@ -100,24 +360,54 @@ def main(args):
         p.error("Choose either --chnames or --template, not both.")
     elif o.template and chapter_type != 'MKV':
         p.error("--template needs to output to .xml.")
+    if o.labels and o.clips:
+        p.error("Choose either --labels or --clips, not both.")
+    elif (o.labels and o.label) or (o.clips and o.clip):
+        p.error("--labels and --clips replace --label and --clip.")
+    elif (o.labels or o.clips) and o.line:
+        p.error("--line can't be used with --labels or --clips.")
+    elif o.otc_v1 and not o.otc:
+        p.error("--timecodes-v1 needs --timecodes.")
+    elif o.delay and len(o.delay) > len(o.input or []):
+        p.error("--delay can only be used once per --input.")
+    if o.tracks:
+        o.tracks = o.tracks.split(',')
+        if not set(o.tracks) <= set(('audio', 'subtitles', 'video')):
+            p.error("--tracks takes audio, subtitles and video.")
 
     if not o.output and o.input:
-        ret = splitext(o.input)
-        o.output = '{0}.cut.mka'.format(ret[0])
+        ret = splitext(o.input[0])
+        ext = '.mka'
+        if len(o.input) == 1:
+            try:
+                # Cut natively into the same format
+                PCMAudio(o.input[0])
+                ext = ret[1]
+            except (OSError, ValueError):
+                pass
+        o.output = '{0}.cut{1}'.format(ret[0], ext)
+    if outdir:
+        for k in ('chapters', 'qpfile', 'otc', 'output'):
+            if getattr(o, k):
+                setattr(o, k, join(outdir, basename(getattr(o, k))))
+        a = a[:1] + [join(outdir, basename(i)) for i in a[1:]]
 
     if o.verbose:
         status = "Avisynth file: \t{0}\n".format(a[0])
         status += "Label: \t\t{0}\n".format(o.label) if o.label else ""
         status += "Clip name: \t{0}\n".format(o.clip) if o.clip else ""
+        status += "Labels: \t{0}\n".format(o.labels) if o.labels else ""
+        status += "Clip names: \t{0}\n".format(o.clips) if o.clips else ""
         status += ("Parsing order: \t{0}\n".format("Bottom to top" if
                     o.reverse else "Top to bottom"))
         status += "Line: \t\t{0}\n".format(o.line) if o.line else ""
-        status += ("Audio file: \t{0}{1}\n".format(o.input, "(SBR)" if o.sbr
-                    else "") if o.input else "")
+        status += ("Audio file: \t{0}{1}\n".format(', '.join(o.input),
+                    "(SBR)" if o.sbr else "") if o.input else "")
         status += "Cut Audio file: {0}\n".format(o.output) if o.output else ""
         status += "Timecodes/FPS: \t{0}{1}\n".format(o.fps, " to " + o.ofps if
                     o.ofps else "") if o.ofps != o.fps else ""
-        status += "Output v2 Tc: \t{0}\n".format(o.otc) if o.otc else ""
+        status += "Output {0} Tc: \t{1}\n".format("v1" if o.otc_v1 else "v2",
+                    o.otc) if o.otc else ""
         status += ("Chapters file: \t{0}{1}\n".format(o.chapters,
                     " ({0})".format(chapter_type) if chapter_type else "") if
                     o.chapters else "")
@@ -137,11 +427,68 @@ def main(args):
         print(status)
 
     # Get frame numbers and corresponding timecodes from avs
-    Trims, Trimsts, Trims2, Trims2ts, audio = parse_trims(a[0], o.fps, o.ofps,
-                                           o.otc if not o.test else '', o.input,
-                                           o.label, o.reverse, o.line, o.clip,
-                                           o.merge)
+    otc = o.otc if not o.test else ''
+    tolerance = o.tolerance if o.otc_v1 else None
+    results = []
+    if o.labels or o.clips:
+        names = (o.labels or o.clips).split(',')
+        selectors = dict((name, (name, o.clip) if o.labels else
+                          (o.label, name)) for name in names)
+        with stage('parse_avs'):
+            found = parse_avs_all(a[0], selectors, o.reverse)
+        with stage('parse_tc'):
+            tc, frames, ofps = trims_tc(max(found.values(), key=last_frame),
+                                        o.fps, o.ofps, otc, tolerance)
+        for name in names:
+            lo = copy(o)
+            if o.labels:
+                lo.label = name
+            else:
+                lo.clip = name
+            for k in ('chapters', 'qpfile', 'output'):
+                if getattr(o, k):
+                    setattr(lo, k, label_path(getattr(o, k), name))
+            la = a[:1] + [label_path(i, name) for i in a[1:]]
+            if o.verbose:
+                print('{0}: {1}\n'.format('Label' if o.labels else 'Clip',
+                                          name))
+            with stage('offset_trims'):
+                trims = offset_trims(found[name], tc, frames, ofps, o.input,
+                                     o.merge)
+            results.append(write_outputs(lo, la, ifps, chapter_type, trims))
+            results[-1]['name'] = name
+    else:
+        results.append(write_outputs(o, a, ifps, chapter_type,
+                       parse_trims(a[0], o.fps, o.ofps, otc, o.input, o.label,
+                                   o.reverse, o.line, o.clip, o.merge,
+                                   tolerance)))
+
+    if o.verbose and (identify_stats['hits'] or identify_stats['misses']):
+        print("Identify cache: {0:d} hits, {1:d} misses".format(
+                identify_stats['hits'], identify_stats['misses']))
+
+    return results
+
+
+def label_path(path, name):
+    """Returns the output path used for a --labels/--clips name."""
+    if '{label}' in path:
+        return path.replace('{label}', name)
+    root, ext = splitext(path)
+    return '{0}.{1}{2}'.format(root, name, ext)
+
+
+def write_outputs(o, a, ifps, chapter_type, trims):
+    """Writes the qpfile, audio, avisynth and chapter outputs of main().
 
+    trims is the tuple returned by parse_trims. Returns a dict with its
+    trims and timecodes, as printed by --verbose.
+
+    """
+    Trims, Trimsts, Trims2, Trims2ts, audio = trims
+    result = {'trims': Trims, 'timecodes': Trimsts, 'out_trims': Trims2,
+              'out_timecodes': [(fmt_time(i[0]), fmt_time(i[1]))
+                                for i in Trims2ts]}
     nt2 = len(Trims2ts)
     if o.verbose:
         print('In trims: {0}\n'.format(', '.join(['({0},{1})'.format(i[0],
@@ -156,14 +503,16 @@ def main(args):
     # make qpfile
     if o.qpfile and not o.template:
         if not o.test:
-            write_qpfile(o.qpfile, Trims2, o.IDR)
+            with stage('write_qpfile'):
+                write_qpfile(o.qpfile, Trims2, o.IDR)
         if o.verbose:
             print('Writing keyframes to {0}\n'.format(o.qpfile))
 
     # make audio cuts
     if o.input:
-        split_audio(audio, o.input, o.output, o.delay, o.sbr, o.merge, o.remove,
-                    o.verbose, o.test)
+        with stage('split_audio'):
+            split_audio(audio, o.input, o.output, o.delay, o.sbr, o.merge,
+                        o.remove, o.verbose, o.test, o.tracks)
 
     # make offseted avs
     if len(a) > 1:
@@ -171,7 +520,8 @@ def main(args):
             from chapparse import writeAvisynth
             fNum = [i[0] for i in Trims2]
             set = {'avs': '"' + a[1] + '"', 'input': '', 'resize': ''}
-            writeAvisynth(set, fNum)
+            with stage('write_avisynth'):
+                writeAvisynth(set, fNum)
         except ImportError:
             print('Script chapparse.py needed for avisynth output to work.')
 
@@ -185,9 +535,11 @@ def main(args):
         if o.template:
             from templates import AutoMKVChapters as amkvc
             output = o.chapters[:-4] if not o.test else None
-            chaps = amkvc(o.template, output=output, avs=a[0], trims=Trims2ts,
-                            kframes=Trims2, uid=o.uid, label=o.label,
-                            ifps=ifps, clip=o.clip, idr=o.IDR)
+            with stage('AutoMKVChapters'):
+                chaps = amkvc(o.template, output=output, avs=a[0],
+                              trims=Trims2ts, kframes=Trims2, uid=o.uid,
+                              label=o.label, ifps=ifps, clip=o.clip,
+                              idr=o.IDR, libraries=o.library)
 
         else:
             # Assign names to each chapter if --chnames
@@ -230,7 +582,8 @@ def main(args):
 
             if not o.test:
                 if chapter_type == 'MKV':
-                    chaps.toxml(o.chapters[:-4])
+                    with stage('toxml'):
+                        chaps.toxml(o.chapters[:-4])
                 else:
                     with open(o.chapters, "w", encoding='utf-8') as output:
                         if chapter_type == 'OGM':
@@ -245,22 +598,271 @@ def main(args):
             print("Writing {} Chapters to {}". format(chapter_type,
                     o.chapters))
 
+    return result
+
+
+def job_args(job):
+    """Turns a --batch job into command line arguments.
+
+    A job is either a list of arguments or a dict of long option names to
+    values, with the avisynth script (or [infile.avs, outfile.avs]) in 'avs'.
+
+    """
+    if not isinstance(job, dict):
+        return [str(arg) for arg in job]
+    args = []
+    for k, v in job.items():
+        if k == 'avs' or v is None or v is False:
+            continue
+        # Lists repeat the option, as in {"input": ["a.flac", "b.ass"]}
+        for value in v if isinstance(v, list) else [v]:
+            args.append('--' + k)
+            if value is not True:
+                args.append(str(value))
+    avs = job.get('avs', [])
+    args.extend([avs] if not isinstance(avs, list) else avs)
+    return args
+
+
+def job_options(args):
+    """Parses the arguments of a --batch or --serve job.
+
+    Raises ValueError for bad options (instead of exiting) and for jobs
+    that would start a --batch or --serve of their own.
+
+    """
+    def invalid(msg):
+        raise ValueError(msg)
+    p = option_parser()
+    p.error = invalid
+    o = p.parse_args(args)[0]
+    if o.batch or o.serve:
+        raise ValueError("--batch and --serve can't be used in a job")
+    return o
+
+
+def run_job(args):
+    """Runs main() and returns its error message, or None on success."""
+    try:
+        main(args)
+    except SystemExit as e:
+        if e.code:
+            return str(e.code)
+    except Exception as e:
+        return '{0}: {1}'.format(type(e).__name__, e)
+
+
+def run_jobs(jobs, audio_processes=2):
+    """Runs a list of (id, args) jobs, cutting their audio in the background.
+    """
+    global audio_scheduler
+    audio_scheduler = CutScheduler(audio_processes)
+    errors = {}
+    try:
+        for i, args in jobs:
+            audio_scheduler.job = i
+            errors[i] = run_job(args)
+        for i, name, code in audio_scheduler.join():
+            if code == 1:
+                print("Mkvmerge exited with warnings: {0:d}".format(code))
+            elif code == 2 and not errors[i]:
+                errors[i] = "Failed to execute mkvmerge: {0:d}".format(code)
+    finally:
+        audio_scheduler = None
+    return sorted(errors.items())
+
+
+def run_batch(manifest, processes=1, audio_processes=2, refresh=False):
+    """Runs every job of a --batch manifest.
+
+    Jobs using the same timecodes/fps and template run one after the other in
+    the same process, so those are only parsed once; the groups are spread
+    over a pool of processes. Audio is cut by up to audio_processes mkvmerge
+    instances per process while the next jobs run. A failed job is reported
+    without stopping the others. refresh (--refresh-cache) is passed on to
+    every job.
+
+    Returns a list with the error message of each job (None if it worked).
+
+    """
+    import json
+    with open(manifest, encoding='utf-8') as mf:
+        jobs = [job_args(job) + (['--refresh-cache'] if refresh else [])
+                for job in json.load(mf)]
+
+    groups = {}
+    errors = [None] * len(jobs)
+    for i, args in enumerate(jobs):
+        try:
+            o = job_options(args)
+        except ValueError as e:
+            errors[i] = 'Invalid options: {0}'.format(e)
+            continue
+        groups.setdefault((o.fps, o.template), []).append((i, args))
+    groups = list(groups.values())
+
+    if processes > 1 and len(groups) > 1:
+        from multiprocessing import Pool
+        from functools import partial
+        pool = Pool(min(processes, len(groups)))
+        try:
+            results = pool.map(partial(run_jobs,
+                                       audio_processes=audio_processes),
+                               groups, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_jobs(group, audio_processes) for group in groups]
+
+    for group in results:
+        for i, error in group:
+            errors[i] = error
+
+    failed = 0
+    for i, error in enumerate(errors):
+        print('Job {0:d} ({1}): {2}'.format(i + 1, ' '.join(jobs[i]),
+              'Failed: ' + error if error else 'OK'))
+        failed += 1 if error else 0
+    if failed:
+        exit('{0:d} of {1:d} jobs failed'.format(failed, len(jobs)))
+    return errors
+
+
+def serve_job(job):
+    """Runs a --serve job and returns its response.
+
+    Output files are written to a temporary directory and returned by name
+    in 'files' (or base64 encoded in 'binary' if they aren't UTF-8 text,
+    like cut audio), instead of being left on disk.
+
+    """
+    from io import StringIO
+    from contextlib import redirect_stdout, redirect_stderr
+    from tempfile import mkdtemp
+    from os import listdir
+    from shutil import rmtree
+    from base64 import b64encode
+
+    args = job_args(job)
+    try:
+        job_options(args)
+    except ValueError as e:
+        return {'error': 'Invalid options: {0}'.format(e), 'log': ''}
+
+    response = {}
+    log = StringIO()
+    outdir = mkdtemp(prefix='vfr')
+    try:
+        with redirect_stdout(log), redirect_stderr(log):
+            response['results'] = main(args, outdir)
+    except SystemExit as e:
+        response['error'] = str(e.code) if e.code else None
+    except Exception as e:
+        response['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    else:
+        response['files'] = {}
+        response['binary'] = {}
+        for name in listdir(outdir):
+            with open(join(outdir, name), 'rb') as f:
+                data = f.read()
+            try:
+                response['files'][name] = data.decode('utf-8')
+            except UnicodeDecodeError:
+                response['binary'][name] = b64encode(data).decode('ascii')
+    finally:
+        rmtree(outdir, True)
+    response['log'] = log.getvalue()
+    return response
+
+
+def serve(path, cache_size=None):
+    """Runs jobs received as JSON over a Unix domain socket until interrupted.
+
+    Each line sent is a job as in --batch, answered by a line with the JSON
+    response of serve_job. Parsed timecodes, templates, identify results and
+    segment indexes are kept between jobs, up to about cache_size bytes for
+    all of them together.
+
+    """
+    import json
+    from os import unlink
+    from socketserver import UnixStreamServer, StreamRequestHandler
+
+    cache_limit.maxsize = cache_size
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    response = serve_job(json.loads(line.decode('utf-8')))
+                except ValueError as e:
+                    response = {'error': 'Invalid job: {0}'.format(e)}
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+    if exists(path):
+        unlink(path)
+    server = UnixStreamServer(path, Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        unlink(path)
+
 
 def fmt_time(ts, msp=False):
     """Converts nanosecond timestamps to timecodes.
     
     msp = Set timecodes for millisecond precision if True
     
+    Integers only, so there's no float rounding to carry into the output.
+    
     """
-    s = ts / 10 ** 9
-    m = s // 60
-    s = s % 60
-    h = m // 60
-    m = m % 60
+    if profiler:
+        profiler.count('fmt_time')
     if msp:
-        return '{:02.0f}:{:02.0f}:{:06.3f}'.format(h, m, s)
+        s, frac = divmod(round_div(ts, 10 ** 6), 1000)
     else:
-        return '{:02.0f}:{:02.0f}:{:012.9f}'.format(h, m, s)
+        s, frac = divmod(ts, 10 ** 9)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    if msp:
+        return '{:02d}:{:02d}:{:02d}.{:03d}'.format(h, m, s, frac)
+    else:
+        return '{:02d}:{:02d}:{:02d}.{:09d}'.format(h, m, s, frac)
+
+
+def parse_time(ts):
+    """Converts timecodes (HH:MM:SS.nnnnnnnnn, any number of decimals, hours
+    and minutes optional) to nanosecond timestamps. Inverse of fmt_time."""
+    ts = ts.split(':')
+    whole = 0
+    for part in ts[:-1]:
+        whole = whole * 60 + int(part)
+    return whole * 60 * 10 ** 9 + parse_decimal(ts[-1], 9)
+
+
+def round_div(n, d):
+    """Returns n / d (d > 0) rounded to an integer, ties to even like
+    round(), without going through Fraction or float."""
+    q, r = divmod(n, d)
+    r *= 2
+    return q + (r > d or r == d and q & 1)
+
+
+def parse_decimal(text, digits):
+    """Returns the decimal number in text (str or bytes) times 10 ** digits,
+    rounded to an integer (see round_div), without going through float."""
+    dot, zero = ('.', '0') if isinstance(text, str) else (b'.', b'0')
+    whole, _, frac = text.strip().partition(dot)
+    if len(frac) > digits:
+        return round_div(int(whole + frac), 10 ** (len(frac) - digits))
+    return int(whole + frac + zero * (digits - len(frac)))
 
 
 def truncate(ts, scale=0):
@@ -283,73 +885,766 @@ def correct_to_ntsc(fps, ms=False):
     """Rounds framerate to NTSC values if close enough.
     Takes and returns a Rational number.
 
-    Ported from FFMS2.
+    Ported from FFMS2. Results are memoized by snap_fps, as v1 timecodes
+    repeat the same few rates over and over.
     """
-    fps = Fraction(fps).limit_denominator(10**6)
-    fps_list = (24, 25, 30, 48, 50, 60, 100, 120)
+    if profiler:
+        profiler.count('correct_to_ntsc')
+    return snap_fps(fps, ms)
 
-    for fps_idx in fps_list:
-        delta = (fps_idx - fps_idx / 1.001) / 2.0
-        if abs(fps - fps_idx) < delta:
-            fps = Fraction(fps_idx, 1)
-            break
-        elif (fps_idx % 25) and (abs(fps - fps_idx / 1.001) < delta):
-            fps = Fraction(fps_idx * 1000, 1001)
+
+@lru_cache(2 ** 12)
+def snap_fps(fps, ms):
+    """correct_to_ntsc without the call count."""
+    fps = Fraction(fps).limit_denominator(10**6)
+    for rate, delta, result in ntsc_rates:
+        if abs(fps - rate) < delta:
+            fps = result
             break
+    return float(1000 / fps) if ms else fps
 
-    if not ms:
-        return fps
-    else:
-        return float(1000 / fps)
 
+def v1_overrides(v1):
+    """Yields (first, last, fps) for each override in the lines of a v1
+    timecodes file, with fps corrected to NTSC. Overrides that are already
+    parsed (like read_tc's) are passed through.
+
+    Each distinct fps string is only corrected once, and every override
+    using it shares the same Fraction.
 
-def convert_v1_to_v2(v1, max, asm, v2=None, first=0):
-    """Converts a given v1 timecodes file to v2 timecodes.
-    
-    Original idea from tritical's tcConv.
-    
     """
-    ts = fn1 = fn2 = last = 0
-    asm = correct_to_ntsc(asm, True)
-    o = []
-    ap = o.append
-    en = str.encode
+    rates = {}
     for line in v1:
+        if isinstance(line, tuple):
+            yield line
+            continue
         ovr = line.split(',')
         if len(ovr) == 3:
-            fn1, fn2, fps = ovr
-            fn1 = int(fn1)
-            fn2 = int(fn2)
-            ovf = correct_to_ntsc(fps, True)
-            while (last < fn1 and last < max):
-                ap(ts)
-                last, ts = last + 1, ts + asm
-            while (last <= fn2 and last < max):
-                ap(ts)
-                last, ts = last + 1, ts + ovf
-    while last < max:
-        ap(ts)
-        last, ts = last + 1, ts + asm
+            fps = rates.get(ovr[2])
+            if fps is None:
+                fps = rates[ovr[2]] = correct_to_ntsc(ovr[2])
+            yield int(ovr[0]), int(ovr[1]), fps
+
+
+def iter_v1_to_v2(v1, max, asm, first=0):
+    """Yields the v2 timestamps (ns) of a given v1 timecodes file.
+
+    Each one is the exact timestamp of its frame rounded to the ns, the same
+    as SegmentTimeline's, kept as an integer in 1/scale ns (scale being the
+    least common denominator of the frame durations seen so far), so nothing
+    drifts however long the file is. Only the current timestamp is kept, so
+    memory use doesn't depend on the number of frames.
+
+    Original idea from tritical's tcConv.
+
+    """
+    from math import gcd
+
+    def ranges():
+        for fn1, fn2, fps in v1_overrides(v1):
+            yield fn1, asm
+            yield fn2 + 1, fps
+        yield max, asm
+
+    asm = correct_to_ntsc(asm)
+    # Frame duration (ns) of each fps, by id() (see SegmentTimeline)
+    durations = {}
+    ts = last = 0
+    scale = 1
+    for end, fps in ranges():
+        end = min(end, max)
+        if end <= last:
+            continue
+        known = durations.get(id(fps))
+        if known is None or known[0] is not fps:
+            known = durations[id(fps)] = fps, 10 ** 9 / Fraction(fps)
+        duration = known[1]
+        if scale % duration.denominator:
+            rescale = duration.denominator // gcd(scale,
+                                                  duration.denominator)
+            ts *= rescale
+            scale *= rescale
+        step = duration.numerator * (scale // duration.denominator)
+        if end <= first:
+            ts += (end - last) * step
+            last = end
+            continue
+        if last < first:
+            ts += (first - last) * step
+            last = first
+        if scale % 2:
+            # No ties to even out with an odd scale (as with NTSC rates), so
+            # rounding is a single floor division
+            half = 2 * ts + scale
+            for fn in range(last, end):
+                yield half // (2 * scale)
+                half += 2 * step
+            ts += (end - last) * step
+        else:
+            for fn in range(last, end):
+                # round_div(ts, scale), inlined
+                q, r = divmod(ts, scale)
+                r *= 2
+                yield q + (r > scale or r == scale and q & 1)
+                ts += step
+        last = end
+
+
+def write_v2(timestamps, v2, first=0, chunk_size=2 ** 16):
+    """Writes timestamps (ns) to a v2 timecodes file, in ms with 6 decimals.
+
+    Lines are formatted and written chunk_size at a time, so timestamps can be
+    any iterable, including iter_v1_to_v2's generator. The file is written
+    under a temporary name and renamed when complete.
+
+    Returns the number of timestamps written.
+
+    """
+    from os import linesep as ls, getpid, replace, unlink
+    line = '{0[0]:d}.{0[1]:06d}' + ls
+    timestamps = iter(timestamps)
+    written = 0
+    tmp = '{0}.{1:d}.tmp'.format(v2, getpid())
+    try:
+        with open(tmp, 'wb', buffering=2 ** 20) as v2f:
+            if first == 0:
+                v2f.write(('# timecode format v2' + ls).encode())
+            while True:
+                chunk = [line.format(divmod(ts, 10 ** 6))
+                         for ts in islice(timestamps, chunk_size)]
+                if not chunk:
+                    break
+                written += len(chunk)
+                v2f.write(''.join(chunk).encode())
+        replace(tmp, v2)
+    except BaseException:
+        if isfile(tmp):
+            unlink(tmp)
+        raise
+    return written
+
+
+def convert_v1_to_v2(v1, max, asm, v2=None, first=0):
+    """Converts a given v1 timecodes file to v2 timecodes.
+
+    Returns a list with every timestamp (ns) for random access. Use
+    iter_v1_to_v2 and write_v2 when only the output file is needed.
+
+    """
+    o = list(iter_v1_to_v2(v1, max, asm, first))
     if v2:
-        with open(v2, 'wb') as v2f:
-            from os import linesep as ls
-            header = [en('# timecode format v2' + ls)] if first == 0 else [b'']
-            v2f.writelines(header + [en(('{0:3.6f}'.format(s)) + ls) for s in
-                            o[first:]])
-    return o[first:]
+        write_v2(o, v2, first)
+    return o
+
+
+def iter_v2(tcfile):
+    """Yields the timestamps (ns) of a v2 timecodes file, a line at a time.
+    """
+    with open(tcfile, 'rb') as tc:
+        for line in tc:
+            stripped = line.strip()
+            if stripped and not stripped.startswith(b'#'):
+                # parse_decimal(stripped, 6), inlined for the usual 6 decimals
+                whole, _, frac = stripped.partition(b'.')
+                yield (int(whole + frac) if len(frac) == 6 else
+                       parse_decimal(stripped, 6))
+
+
+def v1_fps(lo, hi):
+    """Returns the fps to write in v1 timecodes for a frame duration (ns)
+    between lo and hi, as read back by correct_to_ntsc, or None if there's
+    no such fps. NTSC rates come first."""
+    for dur in ((lo + hi) / 2, lo, hi):
+        if dur > 0:
+            fps = '{0:.6f}'.format(float(correct_to_ntsc(10 ** 9 / dur)))
+            rate = correct_to_ntsc(fps)
+            if rate and lo <= 10 ** 9 / rate <= hi:
+                return fps
+    for decimals in (9, 12):
+        fps = '{0:.{1:d}f}'.format(2 * 10 ** 9 / (lo + hi), decimals)
+        rate = correct_to_ntsc(fps)
+        if rate and lo <= 10 ** 9 / rate <= hi:
+            return fps
+
+
+def iter_v2_to_v1(timestamps, tolerance=1):
+    """Yields (first, last, fps) for each run of frames of constant duration
+    in timestamps (ns), fps being the string written to v1 timecodes.
+
+    A run goes on while some duration keeps all its frames, as rebuilt by
+    iter_v1_to_v2, within tolerance ms of the original timestamps, so
+    timestamps rounded to the ms still give long NTSC runs. Only the range
+    of durations left is kept, so memory use doesn't depend on the number
+    of frames.
+
+    """
+    timestamps = iter(timestamps)
+    last = next(timestamps, None)
+    if last is None:
+        exit("There are no timestamps to convert")
+    if abs(last) > tolerance * 10 ** 6:
+        exit("v1 timecodes must start at 0, not at {0:.6f} ms".format(
+             last / 10 ** 6))
+    # Rebuilt timestamps are rounded to the ns, so they can be up to 0.5 ns
+    # further before rounding (a tie rounded the other way is caught by
+    # write_v1's check)
+    margin = tolerance * 10 ** 6 + 0.5
+    # Exact rebuilt timestamp (ns) of the first frame of the run, frame
+    # durations in it so far and the range of durations keeping them within
+    # tolerance
+    rts = Fraction(0)
+    frts = start = n = lo = 0
+    hi = float('inf')
+
+    def run_fps(last):
+        fps = v1_fps(lo, hi)
+        if fps is None:
+            exit("Frames {0:d}-{1:d} can't be kept within {2:g} ms in v1 "
+                 "timecodes".format(start, last, tolerance))
+        return fps
+
+    for ts in timestamps:
+        if ts <= last:
+            exit("Timestamp of frame {0:d} is not increasing".format(
+                 start + n + 1))
+        last = ts
+        n += 1
+        nlo = max(lo, (ts - margin - frts) / n)
+        nhi = min(hi, (ts + margin - frts) / n)
+        if nlo > nhi:
+            fps = run_fps(start + n - 2)
+            yield start, start + n - 2, fps
+            rts += (n - 1) * 10 ** 9 / correct_to_ntsc(fps)
+            frts = float(rts)
+            start += n - 1
+            n = 1
+            nlo = max(0, ts - margin - frts)
+            nhi = ts + margin - frts
+        lo, hi = nlo, nhi
+    if not n:
+        exit("v1 timecodes need at least two timestamps")
+    yield start, start + n - 1, run_fps(start + n - 1)
+
+
+def write_v1(timestamps, v1, tolerance=1, check=None):
+    """Writes timestamps (ns) to a v1 timecodes file (see iter_v2_to_v1).
+
+    The fps of the first run is assumed and the runs at other fps written as
+    overrides. If check is given (the same timestamps again), the file is
+    read back and compared with it before being renamed into place.
+
+    Returns the number of frames written.
+
+    """
+    from os import linesep as ls, getpid, replace, unlink
+    from itertools import zip_longest
+    tmp = '{0}.{1:d}.tmp'.format(v1, getpid())
+    asm = frames = None
+    try:
+        with open(tmp, 'w', buffering=2 ** 20, newline='') as v1f:
+            v1f.write('# timecode format v1' + ls)
+            for fn1, fn2, fps in iter_v2_to_v1(timestamps, tolerance):
+                if asm is None:
+                    asm = fps
+                    v1f.write('Assume {0}{1}'.format(asm, ls))
+                elif fps != asm:
+                    v1f.write('{0:d},{1:d},{2}{3}'.format(fn1, fn2, fps, ls))
+                frames = fn2 + 2
+        if check is not None:
+            with open(tmp) as v1f:
+                rebuilt = iter_v1_to_v2(v1f, frames, asm)
+                for fn, (ts, ots) in enumerate(zip_longest(rebuilt, check)):
+                    if (ts is None or ots is None or
+                            abs(ts - ots) > tolerance * 10 ** 6):
+                        exit("v1 timecodes differ at frame {0:d}".format(fn))
+        replace(tmp, v1)
+    except BaseException:
+        if isfile(tmp):
+            unlink(tmp)
+        raise
+    return frames
+
+
+def write_tc(timestamps, otc, first=0, tolerance=None):
+    """Writes the timestamps (ns) yielded by timestamps() to otc, as v2
+    timecodes, or as v1 ones if tolerance is set (checked against a second
+    call of timestamps()).
+
+    Returns the number of timestamps (v2) or frames (v1) written.
+
+    """
+    if tolerance is None:
+        return write_v2(timestamps(), otc, first)
+    return write_v1(timestamps(), otc, tolerance, timestamps())
+
+
+class TimelineTail(object):
+    """Virtual frames past the end of a timecodes file (see parse_tc).
+
+    They follow the last stored frame at a constant rational frame duration
+    and are computed on lookup, so nothing is stored for them whatever
+    their number. Subclasses provide stored(), the count of real frames.
+
+    """
+
+    # (first virtual frame, timestamp (ns) before it, duration (ns), count)
+    tail = None
+
+    def extrapolate(self, fps, frames):
+        """Makes frames virtual frames at fps follow the last stored one."""
+        n = self.stored()
+        self.tail = (n, self.ts(n - 1), 10 ** 9 / Fraction(fps), frames)
+
+    def tail_len(self):
+        return self.tail[3] if self.tail else 0
+
+    def tail_ts(self, fn):
+        first, start, duration, frames = self.tail or (0, 0, 0, 0)
+        if not 0 <= fn - first < frames:
+            raise IndexError('frame {0:d} is past the end of the timecodes'
+                             .format(fn))
+        return round(start + (fn - first + 1) * duration)
+
+    def duration(self, fn):
+        """Returns the duration (ns) of frame fn."""
+        if self.tail and fn >= self.tail[0]:
+            return round(self.tail[2])
+        return self.ts(fn + 1) - self.ts(fn)
+
+
+class Timeline(TimelineTail):
+    """Frame timestamps of a vfr source, in integer nanoseconds.
+
+    Stored in a packed array (or a memoryview of a mapped .tcidx sidecar)
+    instead of a list of timecodes strings, so lookups are O(1) and don't
+    need to parse floats every time.
+
+    """
+
+    def __init__(self, timestamps=()):
+        if not isinstance(timestamps, (array, memoryview)):
+            timestamps = array('q', timestamps)
+        self.timestamps = timestamps
+
+    def has(self, fn):
+        """Returns whether frame fn has a timestamp."""
+        return fn < len(self)
+
+    def stored(self):
+        return len(self.timestamps)
+
+    def __len__(self):
+        return len(self.timestamps) + self.tail_len()
+
+    def ts(self, fn):
+        """Returns the timestamp (ns) of frame fn."""
+        n = len(self.timestamps)
+        return self.timestamps[fn] if fn < n else self.tail_ts(fn)
+
+    __getitem__ = ts
+
+    def ts_many(self, fns):
+        """Returns the timestamps (ns) of every frame in fns."""
+        return [self.ts(fn) for fn in fns]
+
+    def frame_at(self, ts):
+        """Returns the frame being displayed at timestamp ts (ns)."""
+        return max(bisect_right(self, ts, 0, len(self)) - 1, 0)
+
+
+class LazyTimeline(TimelineTail):
+    """Frame timestamps of a v2 timecodes file, in integer nanoseconds.
+
+    The file is memory-mapped and only indexed as far as the frames
+    requested so far. Each lookup decodes a single line, so opening even
+    huge files is near-instant.
+
+    The index is a table of runs of consecutive lines of the same length:
+    first frame, offset of its line and line length. Timestamps only
+    change width at powers of ten, so most files need a handful of runs and
+    chunks of such lines are indexed without looking at each one.
+
+    """
+
+    chunk_size = 2 ** 16
+
+    def __init__(self, path):
+        from mmap import mmap, ACCESS_READ
+        with open(path, 'rb') as tcf:
+            self.map = mmap(tcf.fileno(), 0, access=ACCESS_READ)
+        self.pos = self.map.find(b'\n') + 1 or len(self.map)
+        self.firsts = array('q')
+        self.starts = array('q')
+        self.widths = array('q')
+        self.frames = 0
+
+    def add(self, pos, width, count):
+        """Indexes count lines of width bytes starting at offset pos."""
+        if (self.widths and self.widths[-1] == width and pos ==
+                self.starts[-1] + (self.frames - self.firsts[-1]) * width):
+            self.frames += count
+            return
+        self.firsts.append(self.frames)
+        self.starts.append(pos)
+        self.widths.append(width)
+        self.frames += count
+
+    @staticmethod
+    def regular(chunk, width):
+        """Returns how many lines at the start of chunk are width bytes
+        long, with no comments, blank lines or spaces."""
+        if width < 2 or chunk.startswith(b'\r'):
+            return 0
+        # Lines up to the first one not ending where the previous ones do
+        ends = chunk[width - 1::width]
+        lines = len(ends) - len(ends.lstrip(b'\n'))
+        for i in (b'#', b' ', b'\t', b'\n\r'):
+            at = chunk.find(i, 0, lines * width)
+            if at != -1:
+                lines = at // width
+        if chunk.count(b'\n', 0, lines * width) != lines:
+            # Shorter lines hide in there: bisect for the last good one
+            lo, hi = 0, lines
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if chunk.count(b'\n', 0, mid * width) == mid:
+                    lo = mid
+                else:
+                    hi = mid
+            lines = lo
+        return lines
+
+    def index(self, fn=None):
+        """Indexes the file up to frame fn (or all of it if None)."""
+        mm = self.map
+        size = len(mm)
+        while self.pos < size and (fn is None or self.frames <= fn):
+            end = mm.find(b'\n', self.pos + self.chunk_size)
+            end = size if end == -1 else end + 1
+            pos = self.pos
+            chunk = mm[pos:end]
+            width = chunk.find(b'\n') + 1
+            count = self.regular(chunk, width)
+            if count:
+                self.add(pos, width, count)
+                self.pos = pos + count * width
+                continue
+            # Starts with a comment, a blank line or the last line
+            for line in chunk.splitlines(True):
+                stripped = line.strip()
+                if stripped and not stripped.startswith(b'#'):
+                    self.add(pos, len(line), 1)
+                pos += len(line)
+            self.pos = end
+
+    def has(self, fn):
+        """Returns whether frame fn has a timestamp."""
+        self.index(fn)
+        return fn < self.frames + self.tail_len()
+
+    def stored(self):
+        self.index()
+        return self.frames
+
+    def __len__(self):
+        return self.stored() + self.tail_len()
+
+    def ts(self, fn):
+        """Returns the timestamp (ns) of frame fn."""
+        self.index(fn)
+        if fn >= self.frames:
+            return self.tail_ts(fn)
+        i = bisect_right(self.firsts, fn) - 1
+        start = self.starts[i] + (fn - self.firsts[i]) * self.widths[i]
+        end = self.map.find(b'\n', start)
+        return parse_decimal(self.map[start:end if end != -1 else None], 6)
+
+    __getitem__ = ts
+
+    def ts_many(self, fns):
+        """Returns the timestamps (ns) of every frame in fns."""
+        return [self.ts(fn) for fn in fns]
+
+    def frame_at(self, ts):
+        """Returns the frame being displayed at timestamp ts (ns).
+
+        Gallops ahead to the first power of two frame past ts before
+        bisecting, so the file is only indexed about as far as ts.
+
+        """
+        hi = 1
+        while self.has(hi) and self.ts(hi) <= ts:
+            hi *= 2
+        if not self.has(hi):
+            hi = len(self)
+        return max(bisect_right(self, ts, hi // 2, hi) - 1, 0)
+
+
+class SegmentTimeline(object):
+    """Frame timestamps of a v1 timecodes file, in integer nanoseconds.
+
+    The file is kept as its table of cfr ranges: first frame, frame duration
+    and exact starting timestamp of each one. Lookups cost O(log ranges) and
+    nothing is expanded per frame or accumulated as floats.
+
+    Durations and starts are integers in 1/scale ns, scale being the least
+    common denominator of the durations of the distinct frame rates, so
+    building the table doesn't need any Fraction arithmetic per range.
+
+    """
+
+    def __init__(self, v1, asm):
+        from math import gcd
+        asm = correct_to_ntsc(asm)
+        ranges = []
+        last = 0
+        for fn1, fn2, fps in v1_overrides(v1):
+            if fn1 > last:
+                ranges.append((last, asm))
+                last = fn1
+            if fn2 >= last:
+                ranges.append((last, fps))
+                last = fn2 + 1
+        ranges.append((last, asm))
+
+        # By id(): v1_overrides shares one Fraction per distinct rate, which
+        # is much cheaper than hashing them
+        durations = {}
+        self.scale = 1
+        for fn, fps in ranges:
+            if id(fps) not in durations:
+                duration = durations[id(fps)] = 10 ** 9 / Fraction(fps)
+                self.scale *= (duration.denominator //
+                               gcd(self.scale, duration.denominator))
+        for key, duration in durations.items():
+            durations[key] = (duration.numerator * self.scale //
+                              duration.denominator)
+
+        self.frames = []
+        self.durations = []
+        self.starts = []
+        for fn, fps in ranges:
+            self.append(fn, durations[id(fps)])
+
+    def append(self, fn, duration):
+        """Starts a new range at frame fn (past the last one), duration
+        (1/scale ns) long per frame."""
+        start = 0
+        if self.frames:
+            start = (self.starts[-1] +
+                     (fn - self.frames[-1]) * self.durations[-1])
+            if self.frames[-1] == fn:
+                del self.frames[-1], self.durations[-1], self.starts[-1]
+            if self.frames and self.durations[-1] == duration:
+                return
+        self.frames.append(fn)
+        self.durations.append(duration)
+        self.starts.append(start)
+
+    def ticks(self, fn):
+        """Returns the timestamp of frame fn in 1/scale ns."""
+        i = bisect_right(self.frames, fn) - 1
+        return self.starts[i] + (fn - self.frames[i]) * self.durations[i]
+
+    def ts_exact(self, fn):
+        """Returns the timestamp (ns) of frame fn as a Fraction."""
+        return Fraction(self.ticks(fn), self.scale)
+
+    def ts(self, fn):
+        """Returns the timestamp (ns) of frame fn."""
+        # Same as round(self.ts_exact(fn)), ties to even
+        ts, rest = divmod(self.ticks(fn), self.scale)
+        rest *= 2
+        return ts + (rest > self.scale or rest == self.scale and ts & 1)
+
+    def ts_many(self, fns):
+        """Returns the timestamps (ns) of every frame in fns."""
+        return [self.ts(fn) for fn in fns]
+
+    def duration(self, fn):
+        """Returns the duration (ns) of frame fn, rounded as get_ts(1) is
+        for its frame rate."""
+        i = bisect_right(self.frames, fn) - 1
+        return round_div(self.durations[i], self.scale)
+
+    def frame_at(self, ts):
+        """Returns the frame being displayed at timestamp ts (ns)."""
+        ticks = ts * self.scale
+        i = max(bisect_right(self.starts, ticks) - 1, 0)
+        fn = self.frames[i] + max(int((ticks - self.starts[i]) //
+                                      self.durations[i]), 0)
+        if self.ts(fn + 1) <= ts:
+            fn += 1
+        elif fn and self.ts(fn) > ts:
+            fn -= 1
+        return fn
+
+
+def tc_version(tcfile):
+    """Returns the format ('v1' or 'v2') of a timecodes file."""
+    with open(tcfile) as tc:
+        ret = vfr_re.search(tc.readline())
+    return ret.group(1) if ret else exit('File is not in a supported format.')
+
+
+def tc_digest(path):
+    """Returns the blake2b digest (16 bytes) of a file."""
+    from hashlib import blake2b
+    h = blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def load_tcidx(tcfile, st):
+    """Maps the .tcidx sidecar of tcfile if it still matches st (its stat).
+
+    A sidecar whose source only changed mtime is checked against its digest
+    and kept if it matches.
+
+    Returns its kind and a sequence of its int64 values, or None.
+
+    """
+    from mmap import mmap, ACCESS_READ
+    path = tcfile + '.tcidx'
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(tcidx_header.size)
+            if len(header) < tcidx_header.size:
+                return None
+            magic, version, kind, size, mtime, count, digest = \
+                tcidx_header.unpack(header)
+            if (magic != tcidx_magic or version != 1 or size != st.st_size or
+                    f.seek(0, 2) != tcidx_header.size + count * 8):
+                return None
+            if mtime != st.st_mtime_ns:
+                if digest != tc_digest(tcfile):
+                    return None
+                if not readonly:
+                    try:
+                        with open(path, 'r+b') as update:
+                            update.write(tcidx_header.pack(
+                                magic, version, kind, size, st.st_mtime_ns,
+                                count, digest))
+                    except OSError:
+                        pass
+            data = memoryview(mmap(f.fileno(), 0, access=ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+    data = data[tcidx_header.size:]
+    if byteorder == 'little':
+        return kind, data.cast('q')
+    values = array('q')
+    values.frombytes(data)
+    values.byteswap()
+    return kind, values
+
+
+def save_tcidx(tcfile, st, kind, values, digest):
+    """Writes the .tcidx sidecar of tcfile, replacing it atomically.
+
+    Silently gives up if it can't be written.
+
+    """
+    from os import getpid, replace, unlink
+    if byteorder != 'little':
+        values = array('q', values)
+        values.byteswap()
+    tmp = '{0}.tcidx.{1:d}.tmp'.format(tcfile, getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(tcidx_header.pack(tcidx_magic, 1, kind, st.st_size,
+                                      st.st_mtime_ns, len(values), digest))
+            values.tofile(f)
+        replace(tmp, tcfile + '.tcidx')
+    except OSError:
+        try:
+            unlink(tmp)
+        except OSError:
+            pass
 
 
-def parse_tc(tcfile, max=0, otc=None, first=0):
+def read_tc(tcfile):
+    """Reads a v1 or v2 timecodes file.
+
+    With use_tcidx, its .tcidx sidecar is mapped instead of parsing the
+    text, and (re)built when missing or stale, unless readonly. v2 files,
+    which can be read lazily (LazyTimeline), only get one with index_v2.
+
+    Returns ('v1', (asm, overrides, has_lines)), with asm and the fps of
+    each override as Fractions and has_lines telling whether anything
+    followed the assumed fps, or ('v2', timeline).
+
+    """
+    from os import stat, access, W_OK
+    st = stat(tcfile)
+    if use_tcidx:
+        cached = load_tcidx(tcfile, st)
+        if cached and cached[0] == 1:
+            data = cached[1]
+            rates = {}
+            overrides = []
+            for i in range(4, len(data), 4):
+                rate = data[i + 2], data[i + 3]
+                fps = rates.get(rate)
+                if fps is None:
+                    fps = rates[rate] = Fraction(*rate)
+                overrides.append((data[i], data[i + 1], fps))
+            return 'v1', (Fraction(data[0], data[1]), overrides,
+                          bool(data[2]))
+        elif cached:
+            return 'v2', Timeline(cached[1])
+
+    version = tc_version(tcfile)
+    build = (use_tcidx and not readonly and
+             access(dirname(abspath(tcfile)), W_OK))
+
+    if version == 'v1':
+        with open(tcfile) as tc:
+            v1 = tc.readlines()[1:]
+        ret = v1.pop(0).split(' ') if v1 else []
+        asm = ret[1] if len(ret) == 2 else exit('there is no assumed fps')
+        asm = correct_to_ntsc(asm)
+        overrides = list(v1_overrides(v1))
+        if build:
+            values = array('q', (asm.numerator, asm.denominator, len(v1), 0))
+            for fn1, fn2, fps in overrides:
+                values.extend((fn1, fn2, fps.numerator, fps.denominator))
+            save_tcidx(tcfile, st, 1, values, tc_digest(tcfile))
+        return 'v1', (asm, overrides, bool(v1))
+
+    if not build or not index_v2:
+        return 'v2', LazyTimeline(tcfile)
+    from hashlib import blake2b
+    h = blake2b(digest_size=16)
+    values = array('q')
+    with open(tcfile, 'rb') as tc:
+        h.update(tc.readline())
+        for line in tc:
+            h.update(line)
+            stripped = line.strip()
+            if stripped and not stripped.startswith(b'#'):
+                # parse_decimal(stripped, 6), inlined for the usual 6 decimals
+                whole, _, frac = stripped.partition(b'.')
+                values.append(int(whole + frac) if len(frac) == 6 else
+                              parse_decimal(stripped, 6))
+    save_tcidx(tcfile, st, 2, values, h.digest())
+    return 'v2', Timeline(values)
+
+
+def parse_tc(tcfile, max=0, otc=None, first=0, tolerance=None):
     """Parses a timecodes file or cfr fps.
     
     tcfile = timecodes file or cfr fps to parse
     max = number of frames to be created in v1 parsing
     otc = output v2 timecodes filename
+    tolerance = if set, otc is written as v1 timecodes within tolerance ms
+                (see write_v1)
     
     """
-
-    cfr_re = compile('(\d+(?:\.\d+)?)(?:/|:)?(\d+(?:\.\d+)?)?')
-    vfr_re = compile('# time(?:code|stamp) format (v1|v2)')
+    if profiler:
+        profiler.count('parse_tc')
 
     ret = cfr_re.search(tcfile)
     if ret and not isfile(tcfile):
@@ -358,130 +1653,179 @@ def parse_tc(tcfile, max=0, otc=None, first=0):
         den = Fraction(ret.group(2)) if ret.group(2) else 1
         timecodes = Fraction(num, den)
         if otc:
-            convert_v1_to_v2([], max + 2, timecodes, otc, first)
+            write_tc(lambda: iter_v1_to_v2([], max + 2, timecodes, first), otc,
+                     first, tolerance)
 
     else:
         type = 'vfr'
-        with open(tcfile) as tc:
-            v1 = tc.readlines()
-        ret = vfr_re.search(v1.pop(0))
-        version = ret.group(1) if ret else exit('File is not in a supported '
-                                                'format.')
-
+        key = (tcfile, getmtime(tcfile), max)
+        if not otc and key in tc_cache:
+            return tc_cache[key], max
+        version, timecodes = read_tc(tcfile)
         if version == 'v1':
-            ret = v1.pop(0).split(' ')
-            asm = ret[1] if len(ret) == 2 else exit('there is no assumed fps')
-            if v1:
-                ret = convert_v1_to_v2(v1, max, asm, otc, first)
-                timecodes = ['{0:3.6f}\n'.format(i) for i in ret]
+            asm, v1, has_lines = timecodes
+            if has_lines:
+                timecodes = SegmentTimeline(v1, asm)
+                if otc:
+                    write_tc(lambda: iter_v1_to_v2(v1, max, asm, first), otc,
+                             first, tolerance)
             else:
-                timecodes = correct_to_ntsc(asm)
+                timecodes = asm
                 type = 'cfr'
                 if otc:
-                    convert_v1_to_v2([], max + 2, timecodes, otc, first)
-
-        elif version == 'v2':
-            if max > len(v1):
-                temp_max = len(v1)
-                sample = temp_max // 100
-                average = 0
-                for i in range(-sample, 0):
-                    average += round(float(v1[i]) - float(v1[i - 1]), 6)
-                fps = correct_to_ntsc(Fraction.from_float(sample / average *
-                                        1000))
-                ret = convert_v1_to_v2([], max - len(v1) + 1, fps, first=1)
-                if v1[-1][-1] is not '\n':
-                    v1[-1] += '\n'
-                v1 += ['{0:3.6f}\n'.format(i + float(v1[-1])) for i in ret]
-            timecodes = v1
+                    write_tc(lambda: iter_v1_to_v2([], max + 2, timecodes,
+                             first), otc, first, tolerance)
+        elif otc and tolerance is not None:
+            write_v1(iter_v2(tcfile), otc, tolerance, iter_v2(tcfile))
+
+        if (type == 'vfr' and version == 'v2' and max and
+                not timecodes.has(max - 1)):
+            total = len(timecodes)
+            sample = total // 100 or 1
+            fps = correct_to_ntsc(Fraction(sample * 10 ** 9,
+                                           timecodes.ts(total - 1) -
+                                           timecodes.ts(total - 1 - sample)))
+            timecodes.extrapolate(fps, max - total)
+
+        tc_cache[key] = (timecodes, type)
 
     return (timecodes, type), max
 
 
+def convert_tc(tcfile, max, otc, first=0, tolerance=None):
+    """Converts a cfr fps or v1 timecodes file to a v2 timecodes file.
+
+    Same output as parse_tc's otc, but timestamps are streamed straight to
+    otc, so memory use stays flat whatever the number of frames. With
+    tolerance, otc is written as v1 timecodes instead (see write_v1), which
+    also converts v2 input in a single pass over it.
+
+    Returns the number of timestamps (v2) or frames (v1) written, or None
+    for v2 input without tolerance.
+
+    """
+
+    ret = cfr_re.search(tcfile)
+    if ret and not isfile(tcfile):
+        num = Fraction(ret.group(1))
+        den = Fraction(ret.group(2)) if ret.group(2) else 1
+        return write_tc(lambda: iter_v1_to_v2([], max + 2, Fraction(num, den),
+                        first), otc, first, tolerance)
+
+    if tc_version(tcfile) != 'v1':
+        if tolerance is not None:
+            return write_v1(iter_v2(tcfile), otc, tolerance, iter_v2(tcfile))
+        return
+    asm, v1, has_lines = read_tc(tcfile)[1]
+    if has_lines:
+        return write_tc(lambda: iter_v1_to_v2(v1, max, asm, first), otc,
+                        first, tolerance)
+    return write_tc(lambda: iter_v1_to_v2([], max + 2, asm, first), otc,
+                    first, tolerance)
+
+
 def get_ts(fn, tc, scale=0):
     """Returns timestamps from a frame number and timecodes file or cfr fps
     
     fn = frame number
-    tc = (timecodes list or Fraction(fps),tc_type)
+    tc = (a Timeline class or Fraction(fps),tc_type)
     
     scale default: 0 (ns)
     examples: 3 (µs); 6 (ms); 9 (s)
     
     """
-    scale = 9 - scale
+    if profiler:
+        profiler.count('get_ts')
     tc, tc_type = tc
     if tc_type == 'cfr':
-        ts = round(10 ** scale * fn * Fraction(tc.denominator, tc.numerator))
-        return ts
+        return round_div(10 ** (9 - scale) * fn * tc.denominator,
+                         tc.numerator)
     elif tc_type == 'vfr':
-        ts = round(float(tc[fn]) * 10 ** (scale - 3))
-        return ts
+        ts = tc.ts(fn)
+        return ts if not scale else round_div(ts, 10 ** scale)
 
 
-def convert_fps(ofn, old, new, oldts=None):
-    """Returns a frame number from fps and ofps (ConvertFPS)
-    
-    fn = frame number
-    old = original fps ('30000/1001', '25')
-    new = output fps ('24000/1001', etc.)
-    
+def get_frame(ts, tc):
+    """Returns the first frame whose timestamp is at or after ts (ns).
+
+    Inverse of get_ts: closed form for cfr, bisect for timecodes.
+
     """
+    if profiler:
+        profiler.count('get_frame')
+    if tc[1] == 'cfr':
+        fn = max(-(-ts * tc[0].numerator //
+                   (tc[0].denominator * 10 ** 9)), 0)
+        if fn and get_ts(fn - 1, tc) >= ts:
+            fn -= 1
+    else:
+        fn = tc[0].frame_at(ts)
+        if tc[0].ts(fn) < ts:
+            fn += 1
+    return fn
+
+
+def convert_frames(fns, old, new, oldts=None, oldfn=None):
+    """Maps a list of frame numbers from old to new fps/timecodes at once.
+
+    fns = increasing frame numbers, such as flattened trims
+    oldts = timestamps of the frames in fns, if they aren't those of old
+    oldfn = frames of old starting at oldts (defaults to fns)
+
+    Returns the new frame numbers and their timestamps (ns). Each frame
+    becomes the first new frame starting no earlier than one old frame
+    before it, that is the duration of the old frame just before it for
+    vfr. A frame mapped to the same new frame as the previous one moves the
+    previous one back a frame, so adjacent trims stay apart.
+
+    Each frame is looked up directly with get_frame, so the cost depends on
+    the number of frames mapped, not on their frame numbers.
+
+    """
+    if old[1] == 'vfr':
+        thrs = [old[0].duration(max(fn, 1) - 1) for fn in oldfn or fns]
+    else:
+        thrs = [get_ts(1, old)] * len(fns)
+
+    if oldts is None:
+        if old[1] == 'vfr':
+            oldts = old[0].ts_many(fns)
+        else:
+            oldts = [get_ts(fn, old) for fn in fns]
 
-    newts = 0
-    nfn = 0
-    thr = get_ts(1, old)  # milliseconds
     newframes = []
     newtimestamps = []
-    temp = temp2 = []
+    nfn = 0
+    for ots, thr in zip(oldts, thrs):
+        moved = ots - get_ts(nfn, new) >= thr
+        nfn = max(nfn, get_frame(ots - thr, new))
+        nts = get_ts(nfn, new)
+        if len(newframes) != 0 and nfn == newframes[-1]:
+            newframes[-1] -= 1
+            if moved:
+                newtimestamps[-1] = get_ts(newframes[-1], new)
+        newframes.append(nfn)
+        newtimestamps.append(nts)
+    return newframes, newtimestamps
+
+
+def convert_fps(ofn, old, new, oldts=None, oldfn=None):
+    """Returns a frame number from fps and ofps (ConvertFPS)
     
-    for i in ofn:
-        for j in i:
-            temp.append(j)
+    fn = frame number
+    old = original fps ('30000/1001', '25')
+    new = output fps ('24000/1001', etc.)
+    oldts = timestamps of the frames in fn, if they aren't those of old
+    oldfn = frames of old starting at oldts (defaults to fn)
     
-    ofn = temp
+    The trims are mapped by convert_frames.
     
-    if not oldts:
-        oldtsi = []
-        for fn in ofn:
-            oldtsi.append(get_ts(fn, old))
-    else:
-        oldtsi = []
-        for i in oldts:
-            for j in i:
-                oldtsi.append(j)
-
-    for i in range(len(ofn)):
+    """
 
-        fn = ofn[i]
-        ots = oldtsi[i]
-        nts = get_ts(nfn, new)
-        if ots - nts >= thr:
-            while (ots - nts > thr):
-                nfn += 1
-                nts = get_ts(nfn, new)
-            if len(newframes) != 0 and nfn == newframes[-1]:
-                newframes[-1] -= 1
-                newtimestamps[-1] = get_ts(newframes[-1], new)
-                newframes.append(nfn)
-                newtimestamps.append(nts)
-            else:
-                newframes.append(nfn)
-                newtimestamps.append(nts)
-        elif ots - nts < thr:
-            if len(newframes) != 0 and nfn == newframes[-1]:
-                newframes[-1] -= 1
-                newframes.append(nfn)
-                newtimestamps.append(nts)
-            else:
-                newframes.append(nfn)
-                newtimestamps.append(nts)
-        else:
-            nfn = 0
-            while (ots - nts > thr):
-                nfn += 1
-                nts = get_ts(nfn, new)
-            newframes.append(nfn)
-            newtimestamps.append(nts)
+    newframes, newtimestamps = convert_frames(
+        [j for i in ofn for j in i], old, new,
+        [j for i in oldts for j in i] if oldts else None,
+        [j for i in oldfn for j in i] if oldfn else None)
 
     if len(newframes) % 2 == 0:
         temp = []
@@ -497,13 +1841,111 @@ def convert_fps(ofn, old, new, oldts=None):
         return newframes
 
 
+def avs_trims(line):
+    """Tokenize the uncommented Trim() calls of an avisynth line.
+
+    Handles Trim(a,b), clip.Trim(a,b) and Trim(clip,a,b) joined by any
+    splice operator, in a single linear pass. Everything after the first '#'
+    is a comment and ignored.
+
+    Returns a list of (name, clip, first, last) with name as written, clip
+    None for unbound calls and first/last as ints.
+
+    """
+    return [(m.group(2), m.group(1) or m.group(3), int(m.group(4)),
+             int(m.group(5))) for m in trim_re.finditer(line.partition('#')[0])]
+
+
+def reverse_lines(f, block_size=2**16):
+    """Yield the lines of a binary file from last to first.
+
+    Reads blocks backwards from EOF, so only the tail of the file up to the
+    last line wanted is ever read.
+
+    """
+    f.seek(0, 2)
+    pos = f.tell()
+    chunks = []
+    while pos:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size)
+        lines = block.split(b'\n')
+        if len(lines) == 1:
+            chunks.append(block)
+            continue
+        lines[-1] += b''.join(reversed(chunks))
+        chunks = [lines[0]]
+        for line in reversed(lines[1:]):
+            yield line
+    yield b''.join(reversed(chunks))
+
+
+def avs_lines(avsfile, reverse=None, line_number=None):
+    """Lazily decode the lines of an avisynth script opened in binary mode.
+
+    Scans forwards, backwards from EOF with reverse or only the single line
+    line_number. Lines that are never reached are never decoded.
+
+    """
+    encoding = getpreferredencoding(False)
+    if line_number:
+        lines = islice(avsfile, line_number - 1, line_number)
+    elif reverse:
+        lines = reverse_lines(avsfile)
+    else:
+        lines = avsfile
+    for line in lines:
+        yield line.decode(encoding)
+
+
+def trim_matcher(label=None, clip=None):
+    """Returns a function giving the trims picked from a line, or None.
+
+    label and clip work as in parse_avs. The function takes the line and
+    optionally the tokenizer to use on it (see avs_trims).
+
+    """
+    trim_label = label if label and label.lower() == 'trim' else None
+    comment = compile('(?i)' + label) if label and not trim_label else None
+    trim_clip = clip.lower() if clip else None
+
+    def match(line, tokenize=avs_trims):
+        if comment and not comment.search(line.partition('#')[2]):
+            return None
+        trims = tokenize(line)
+        if trim_clip:
+            trims = [t for t in trims if t[1] and t[1].lower() == trim_clip]
+        if not trims:
+            return None
+        if trim_label and not any(t[0] == trim_label for t in trims):
+            return None
+        return [(t[2], t[3]) for t in trims]
+    return match
+
+
+def no_trims(label=None, line_number=None, clip=None):
+    """Exits with the error for a script lacking the requested trims."""
+    if label:
+        exit("Error: Avisynth script has no uncommented trims with label "
+             "'{}'".format(label))
+    if line_number:
+        exit("Error: Avisynth script has no uncommented trims on line {}"
+             .format(line_number))
+    if clip:
+        exit("Error: Avisynth script has no uncommented trims with clip "
+             "'{}'".format(clip))
+    exit("Error: Avisynth script has no uncommented trims")
+
+
 def parse_avs(avs, label=None, reverse=None, line_number=None, clip=None):
     """Parse an avisynth file. Scours it for the first uncommented trim line.
     
     By default it looks for case-insensitive 'trim'. Using label, you can make
     it parse only the line starting with a certain case of trim, ignoring the
     others. Ex: label = 'tRiM' looks for the line starting with tRiM, ignoring
-    other cases.
+    other cases. Any other label must appear in the line's comment.
     
     Returns a list with pairs of frames containing the first and last of each
     trim.
@@ -512,53 +1954,56 @@ def parse_avs(avs, label=None, reverse=None, line_number=None, clip=None):
     
     Trims = []
 
-    trim_label = 'trim'
-    comment = ''
-    ignore_case = '(?i)'
-    trim_clip = ''
-    
     if line_number:
         label = None
-    if label and label.lower() == 'trim':
-        trim_label = label
-        comment = ''
-        ignore_case = ''
-    elif label:
-        comment = '#.*' + label
-    if clip:
-        trimre = compile('(?<!#)(?:{0}\.trim\(|trim\({0}\s*,\s*)(\d+)\s*,\s*(-?\d+)\)(?i)'.format(clip))
-        findTrims = compile("(?<!#)[^#]*(?:{1}\.{0}\(|{0}\({1}\s*,\s*)(\d+)\s*,"
-                            "\s*(-?\d+)\).*{2}{3}".format(trim_label, clip, comment, ignore_case))
-    else:
-        trimre = compile('(?<!#)(?:\w+\.)?trim\((?:\w+\s*,\s*)?(\d+)\s*,\s*(-?\d+)\)(?i)'.format(clip))
-        findTrims = compile("(?<!#)[^#]*\s*\.?\s*{0}\((?:\w+\s*,\s*)?(\d+)\s*,"
-                            "\s*(-?\d+)\).*{1}{2}".format(trim_label, comment, ignore_case))
+    match = trim_matcher(label, clip)
 
-    with open(avs) as avsfile:
-        avs = avsfile.readlines()
-    if line_number:
-        avs = avs[line_number - 1:line_number]
-    for line in avs if not reverse else reversed(avs):
-        if findTrims.match(line):
-            Trims = trimre.findall(line)
-            break
+    with open(avs, 'rb') as avsfile:
+        for line in avs_lines(avsfile, reverse, line_number):
+            Trims = match(line)
+            if Trims:
+                break
     if not Trims:
-        if label:
-            exit("Error: Avisynth script has no uncommented trims with label "
-                 "'{}'".format(label))
-        if line_number:
-            exit("Error: Avisynth script has no uncommented trims on line {}"
-                 .format(line_number))
-        if clip:
-            exit("Error: Avisynth script has no uncommented trims with clip "
-                 "'{}'".format(clip))
-        exit("Error: Avisynth script has no uncommented trims")
+        no_trims(label, line_number, clip)
 
     return Trims
 
 
+def parse_avs_all(avs, selectors, reverse=None):
+    """Parse the trims of several labels and/or clips in one pass.
+
+    selectors maps a name to a (label, clip) pair, each working as in
+    parse_avs. Scanning stops as soon as every selector found its line.
+
+    Returns a dict mapping each name to its list of trims.
+
+    """
+
+    pending = dict((name, trim_matcher(label, clip)) for name, (label, clip)
+                   in selectors.items())
+    found = {}
+    tokenize = lru_cache(1)(avs_trims)
+
+    with open(avs, 'rb') as avsfile:
+        for line in avs_lines(avsfile, reverse):
+            for name, match in list(pending.items()):
+                Trims = match(line, tokenize)
+                if Trims:
+                    found[name] = Trims
+                    del pending[name]
+            if not pending:
+                break
+    for name in selectors:
+        if name not in found:
+            label, clip = selectors[name]
+            no_trims(label, clip=clip)
+
+    return found
+
+
 def parse_trims(avs, fps, outfps=None, otc=None, input=None, label=None,
-                reverse=None, line_number=None, clip=None, merge=True):
+                reverse=None, line_number=None, clip=None, merge=True,
+                tolerance=None):
     """Parse trims from an avisynth file.
 
     Returns 5 lists containing:
@@ -574,36 +2019,69 @@ def parse_trims(avs, fps, outfps=None, otc=None, input=None, label=None,
 
     """
 
-    Trims = parse_avs(avs, label, reverse, line_number, clip)
+    with stage('parse_avs'):
+        Trims = parse_avs(avs, label, reverse, line_number, clip)
+    with stage('parse_tc'):
+        tc, max, ofps = trims_tc(Trims, fps, outfps, otc, tolerance)
+    with stage('offset_trims'):
+        return offset_trims(Trims, tc, max, ofps, input, merge)
+
+
+def last_frame(Trims):
+    """Returns the last frame used by a list of trims."""
+    last = Trims[-1][1]
+    if last < 0:
+        last = Trims[-1][0] - Trims[-1][1] - 1
+    elif last == 0:
+        last = Trims[-1][0]
+    return last
+
+
+def trims_tc(Trims, fps, outfps=None, otc=None, tolerance=None):
+    """Parse the timecodes/fps needed by a list of trims.
+
+    Returns the input timecodes, their frame count and the output ones
+    (None unless outfps converts them), as used by offset_trims.
+
+    """
+    tc, max = parse_tc(fps, last_frame(Trims) + 2, otc, tolerance=tolerance)
+    ofps = None
+    if outfps and fps != outfps:
+        frames = Trims[-1][1] + 2
+        ofps = parse_tc(outfps, frames)[0]
+        # As many output frames may end before the input ones: v2 timecodes
+        # are extrapolated further until they do
+        end = get_ts(last_frame(Trims) + 1, tc)
+        while (isinstance(ofps[0], TimelineTail) and
+               get_ts(frames - 1, ofps) <= end):
+            frames = frames * 2 if frames > 1 else 2
+            ofps = parse_tc(outfps, frames)[0]
+        if otc:
+            max = convert_fps([[Trims[-1][1]]], tc, ofps)[0]
+            parse_tc(outfps, max + 2, otc + '.ofps.txt', tolerance=tolerance)
+    return tc, max, ofps
+
+
+def offset_trims(Trims, tc, max, ofps=None, input=None, merge=True):
+    """Compute the timecodes and offsets of a list of trims.
+
+    Returns the same lists as parse_trims.
+
+    """
     audio = []
     Trimsts = []
     Trims2 = []
     Trims2ts = []
+    Trimsfn = []
     nt1 = len(Trims)
     adjacent = False
 
-    # Parse timecodes/fps
-    last_frame = int(Trims[-1][1])
-    if last_frame < 0:
-        last_frame = int(Trims[-1][0]) - int(Trims[-1][1]) - 1
-    elif last_frame == 0:
-        last_frame = int(Trims[-1][0])
-
-    tc, max = parse_tc(fps, last_frame + 2, otc)
-    if tc[1] == 'vfr' and outfps:
-        exit("Can't use --ofps with timecodes file input")
-    if outfps and fps != outfps:
-        ofps = parse_tc(outfps, int(Trims[-1][1]) + 2)[0]
-        if otc:
-            max = convert_fps([[int(Trims[-1][1])]], tc, ofps)[0]
-            parse_tc(outfps, max + 2, otc + '.ofps.txt')
-
     # Parse trims
     for i in range(nt1):
-        fn1 = int(Trims[i][0])
+        fn1 = Trims[i][0]
         fn1ts = get_ts(fn1, tc)
         fn1tsaud = get_ts(fn1, tc)
-        fn2 = int(Trims[i][1])
+        fn2 = Trims[i][1]
         if fn2 > 0:
             fn2ts = get_ts(fn2 + 1, tc)
             fn2tsaud = get_ts(fn2 + 1, tc)
@@ -619,6 +2097,7 @@ def parse_trims(avs, fps, outfps=None, otc=None, input=None, label=None,
             fn2ts = 0
             fn2tsaud = 0
             Trimsts.append((fmt_time(fn1ts), 0))
+        Trimsfn.append((fn1, fn2 + 1 if fn2 else 0))
 
         # Calculate offsets for non-continuous trims
         if i == 0:
@@ -630,7 +2109,7 @@ def parse_trims(avs, fps, outfps=None, otc=None, input=None, label=None,
                 offsetts = fn1ts
         else:
             # If it's not the first trim
-            last = int(Trims[i - 1][1])
+            last = Trims[i - 1][1]
             lastts = get_ts(last + 1, tc)
             adjacent = True if not fn1 - (last + 1) else False
             offset += fn1 - (last + 1)
@@ -657,8 +2136,10 @@ def parse_trims(avs, fps, outfps=None, otc=None, input=None, label=None,
         Trims2ts.append((fn1ts, fn2ts))
 
     # Convert fps if ofps is supplied
-    if outfps and fps != outfps:
-        Trims2, Trims2ts = convert_fps(Trims2, tc, ofps, Trims2ts)
+    if ofps:
+        with stage('convert_fps'):
+            Trims2, Trims2ts = convert_fps(Trims2, tc, ofps, Trims2ts,
+                                           Trimsfn)
 
     return Trims, Trimsts, Trims2, Trims2ts, audio
 
@@ -672,11 +2153,128 @@ def write_qpfile(qpfile, trims, idr=False):
         for trim in trims:
             qpf.write('{0} {1}\n'.format(trim[0], 'I' if idr else 'K'))
 
-def split_audio(trims, input_file, output_file=None, delay=None, sbr=False,
-                merge=True, remove=True, verbose=False, test=False):
-    from subprocess import call, check_output
-    from sys import getfilesystemencoding
+def user_cache_dir():
+    """Returns the directory where vfr.py keeps its caches."""
+    from os import environ
+    from os.path import expanduser
+    base = (environ.get('LOCALAPPDATA') or environ.get('XDG_CACHE_HOME') or
+            join(expanduser('~'), '.cache'))
+    return join(base, 'vfr')
+
+
+def save_json(path, data):
+    """Writes data to a JSON file, replacing it atomically."""
     import json
+    from os import makedirs, replace
+    from os.path import isdir
+    from tempfile import NamedTemporaryFile
+    if dirname(path) and not isdir(dirname(path)):
+        makedirs(dirname(path))
+    with NamedTemporaryFile('w', dir=dirname(path) or '.', suffix='.tmp',
+                            delete=False) as tmp:
+        json.dump(data, tmp)
+    replace(tmp.name, path)
+
+
+def identify(path):
+    """Returns the container properties and tracks of a file, as given by
+    mkvmerge --identify -F json.
+
+    Results are cached on disk by path, size and mtime, so unchanged files
+    aren't scanned again. Only track ids/types, aac_is_sbr, segment_uid and
+    duration are kept. With identify_refresh (--refresh-cache), each file is
+    identified again the first time it's asked for in a run (main() empties
+    identify_refreshed). Nothing is saved when readonly (--test).
+
+    """
+    global identify_loaded
+    import json
+    from os import stat
+    from subprocess import check_output
+
+    cache_file = identify_cache_file or join(user_cache_dir(),
+                                             'identify.json')
+    if not identify_loaded:
+        identify_loaded = True
+        if isfile(cache_file):
+            try:
+                with open(cache_file, encoding='utf-8') as cf:
+                    for k, entry in json.load(cf).items():
+                        identify_cache[k] = entry
+            except ValueError:
+                pass
+
+    st = stat(path)
+    key = abspath(path)
+    entry = identify_cache.get(key)
+    if identify_refresh and key not in identify_refreshed:
+        entry = None
+    if (entry and entry['size'] == st.st_size and
+            entry['mtime'] == st.st_mtime_ns):
+        identify_stats['hits'] += 1
+        return entry['info']
+
+    identify_stats['misses'] += 1
+    info = json.loads(check_output([mkvmerge, '--identify', '-F', 'json',
+                                    '--output-charset', 'utf-8',
+                                    path]).decode('utf-8'))
+    props = info.get('container', {}).get('properties', {})
+    tracks = []
+    for track in info.get('tracks', []):
+        tprops = track.get('properties', {})
+        tracks.append({'id': track.get('id', 0), 'type': track.get('type'),
+                       'properties': dict((k, tprops[k]) for k in
+                                          ('aac_is_sbr',) if k in tprops)})
+    info = {'container': {'properties': dict((k, props[k]) for k in
+                          ('segment_uid', 'duration') if k in props)},
+            'tracks': tracks}
+    identify_cache[key] = {'size': st.st_size, 'mtime': st.st_mtime_ns,
+                           'info': info}
+    identify_refreshed.add(key)
+    if readonly:
+        return info
+    try:
+        save_json(cache_file, identify_cache.dict())
+    except (IOError, OSError):
+        pass
+    return info
+
+
+def split_audio(trims, input_file, output_file=None, delay=None, sbr=False,
+                merge=True, remove=True, verbose=False, test=False,
+                tracks=None):
+    """Cuts the tracks of one or more files into output_file.
+
+    input_file and delay can be lists, delay[i] being the ms input_file[i]
+    is delayed by (taken from DELAY in its name if missing). All the files
+    are cut by a single mkvmerge command, so each one is read once, except
+    PCM WAV/RF64/W64 alone, which is cut natively (see cut_pcm).
+    tracks = track types kept from each file (all if None)
+
+    """
+    inputs = [input_file] if isinstance(input_file, str) else input_file
+    delays = list(delay) if isinstance(delay, list) else [delay]
+    delays += [None] * (len(inputs) - len(delays))
+
+    # determine delay
+    delre = compile('DELAY ([-]?\d+)')
+    for i, name in enumerate(inputs):
+        ret = delre.search(name)
+        if not delays[i] and ret:
+            delays[i] = ret.group(1)
+
+    # PCM is cut here, unless it's wanted in Matroska
+    if (len(inputs) == 1 and
+            splitext(output_file)[1].lower() not in ('.mka', '.mkv')):
+        try:
+            wave = PCMAudio(inputs[0])
+        except (OSError, ValueError):
+            wave = None
+        if wave:
+            cut_pcm(wave, trims, output_file,
+                    parse_decimal(str(delays[0]), 6) if delays[0] else 0,
+                    merge, verbose, test)
+            return
 
     sep = ',+' if merge else ','
     final_part = ''
@@ -685,31 +2283,11 @@ def split_audio(trims, input_file, output_file=None, delay=None, sbr=False,
     cuttimes = sep.join(['{}-{}'.format(trims[i], trims[i + 1]) for i in range(0,len(trims),2)])
     cuttimes += final_part
 
-    ident = check_output([mkvmerge, "--identify", "-F", "json", input_file])
-    tid = 0
-    try:
-        info = json.loads(ident)
-        for track in info["tracks"]:
-            if track.get("type") == "audio":
-                tid = track.get("id", 0)
-                sbr = track.get("properties", {}).get("aac_is_sbr", False)
-                break
-    except Exception:
-        pass
-
-    # determine delay
-    delre = compile('DELAY ([-]?\d+)')
-    ret = delre.search(input_file)
-    delay = ('{0}:{1}'.format(tid, delay if delay else ret.group(1))
-            if delay or ret else None)
-
     cutCmd = [mkvmerge, '-o', output_file]
-    cutCmd.extend([input_file, '--split'])
-    cutCmd.extend(['parts:' + cuttimes])
-    if delay:
-        cutCmd.extend(['--sync', delay])
-    if sbr:
-        cutCmd.extend(['--aac-is-sbr', str(tid)])
+    for name, delay in zip(inputs, delays):
+        cutCmd.extend(track_options(name, delay, sbr, tracks))
+        cutCmd.append(name)
+    cutCmd.extend(['--split', 'parts:' + cuttimes])
 
     if verbose:
         print('Cutting: {0}\n'.format(
@@ -718,11 +2296,450 @@ def split_audio(trims, input_file, output_file=None, delay=None, sbr=False,
         cutCmd.append('-q')
 
     if not test:
-        cutExec = call(cutCmd)
-        if cutExec == 1:
-            print("Mkvmerge exited with warnings: {0:d}".format(cutExec))
-        elif cutExec == 2:
-            exit("Failed to execute mkvmerge: {0:d}".format(cutExec))
+        if audio_scheduler:
+            audio_scheduler.add(cutCmd, output_file)
+        else:
+            cuts = CutScheduler()
+            cuts.add(cutCmd, output_file)
+            for job, name, cutExec in cuts.join():
+                if cutExec == 1:
+                    print("Mkvmerge exited with warnings: {0:d}".format(
+                          cutExec))
+                elif cutExec == 2:
+                    exit("Failed to execute mkvmerge: {0:d}".format(cutExec))
+
+
+def track_options(input_file, delay=None, sbr=False, tracks=None):
+    """Returns the mkvmerge options of one source of split_audio.
+
+    Drops the track types not in tracks, and sets the delay (--sync) and
+    SBR flag of each audio and subtitle track found by identify. If it
+    fails, the file is taken as a single audio track with id 0.
+
+    """
+    try:
+        found = [(track.get('id', 0), track.get('type'),
+                  track.get('properties', {}).get('aac_is_sbr', False))
+                 for track in identify(input_file)['tracks']]
+    except Exception:
+        found = [(0, 'audio', sbr)]
+    options = []
+    if tracks:
+        for kind, flag in (('video', '-D'), ('audio', '-A'),
+                           ('subtitles', '-S')):
+            if kind not in tracks:
+                options.append(flag)
+    for tid, kind, is_sbr in found:
+        if kind not in ('audio', 'subtitles') or tracks and kind not in tracks:
+            continue
+        if delay:
+            options.extend(['--sync', '{0}:{1}'.format(tid, delay)])
+        if is_sbr:
+            options.extend(['--aac-is-sbr', str(tid)])
+    return options
+
+
+class PCMAudio(object):
+    """Layout of a RIFF WAV, RF64 or Sony Wave64 file with PCM samples.
+
+    Raises ValueError for anything else (compressed audio in a WAV too).
+
+    """
+
+    # Sony Wave64 chunk ids: 'riff' and 'wave' have their own GUIDs, the
+    # others are the fourcc followed by a common suffix
+    w64_riff = b'riff\x2e\x91\xcf\x11\xa5\xd6\x28\xdb\x04\xc1\x00\x00'
+    w64_suffix = b'\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+    w64_wave = b'wave' + w64_suffix
+    # WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT
+    formats = (1, 3)
+
+    def __init__(self, path):
+        from struct import unpack_from
+        from os.path import getsize
+        self.path = path
+        size = getsize(path)
+        with open(path, 'rb') as f:
+            head = f.read(40)
+            if head[:4] in (b'RIFF', b'RF64') and head[8:12] == b'WAVE':
+                self.kind = 'wav' if head[:4] == b'RIFF' else 'rf64'
+                chunks = self.riff_chunks(f, size)
+            elif head[:16] == self.w64_riff and head[24:40] == self.w64_wave:
+                self.kind = 'w64'
+                chunks = self.w64_chunks(f, size)
+            else:
+                raise ValueError('not a WAV, RF64 or W64 file')
+            self.fmt = self.data_offset = None
+            ds64 = None
+            for cid, offset, length in chunks:
+                if cid == b'ds64' and length >= 16:
+                    f.seek(offset)
+                    ds64 = unpack_from('<8xQ', f.read(16))[0]
+                elif cid == b'fmt ':
+                    f.seek(offset)
+                    self.fmt = f.read(length)
+                elif cid == b'data':
+                    if length == 0xFFFFFFFF and ds64 is not None:
+                        length = ds64
+                    self.data_offset = offset
+                    # Streamed files may leave the size unset
+                    self.data_size = min(length or size, size - offset)
+                    break
+        if self.fmt is None or self.data_offset is None or len(self.fmt) < 16:
+            raise ValueError('no fmt or data chunk')
+        (tag, self.channels, self.rate, _, self.block_align,
+         self.bits) = unpack_from('<HHIIHH', self.fmt)
+        if tag == 0xFFFE and len(self.fmt) >= 26:
+            # WAVE_FORMAT_EXTENSIBLE, whose sub format starts with the tag
+            tag = unpack_from('<H', self.fmt, 24)[0]
+        if tag not in self.formats or not self.block_align or not self.rate:
+            raise ValueError('not PCM audio')
+        self.frames = self.data_size // self.block_align
+        # Unsigned 8 bit samples are silent at 128
+        self.silence = b'\x80' if tag == 1 and self.bits <= 8 else b'\0'
+
+    @staticmethod
+    def riff_chunks(f, size):
+        """Yields (id, data offset, length) of the chunks of a RIFF file."""
+        from struct import unpack
+        offset = 12
+        while offset + 8 <= size:
+            f.seek(offset)
+            cid, length = unpack('<4sI', f.read(8))
+            yield cid, offset + 8, length
+            offset += 8 + length + (length & 1)
+
+    @classmethod
+    def w64_chunks(cls, f, size):
+        """Yields (id, data offset, length) of the chunks of a W64 file."""
+        from struct import unpack
+        offset = 40
+        while offset + 24 <= size:
+            f.seek(offset)
+            guid, length = unpack('<16sQ', f.read(24))
+            if length < 24:
+                break
+            cid = guid[:4] if guid[4:] == cls.w64_suffix else guid
+            yield cid, offset + 24, length - 24
+            offset += -(-length // 8) * 8
+
+    def header(self, data_size):
+        """Returns the header and trailing padding of a file of this format
+        holding data_size bytes of samples.
+
+        WAV becomes RF64 when the sizes don't fit in 32 bits.
+
+        """
+        from struct import pack
+        fmt = self.fmt
+        if self.kind == 'w64':
+            fmt += b'\0' * (-len(fmt) % 8)
+            pad = -data_size % 8
+            chunks = (b'fmt ' + self.w64_suffix + pack('<Q', 24 +
+                      len(self.fmt)) + fmt + b'data' + self.w64_suffix +
+                      pack('<Q', 24 + data_size))
+            return (self.w64_riff + pack('<Q', 40 + len(chunks) + data_size +
+                    pad) + self.w64_wave + chunks), pad
+        fmt += b'\0' * (len(fmt) & 1)
+        pad = data_size & 1
+        chunks = b'fmt ' + pack('<I', len(self.fmt)) + fmt
+        riff_size = 4 + len(chunks) + 8 + data_size + pad
+        if self.kind == 'wav' and riff_size + 36 <= 0xFFFFFFFF:
+            return (b'RIFF' + pack('<I', riff_size) + b'WAVE' + chunks +
+                    b'data' + pack('<I', data_size)), pad
+        ds64 = pack('<QQQI', riff_size + 36, data_size,
+                    data_size // self.block_align, 0)
+        return (b'RF64\xff\xff\xff\xffWAVE' + b'ds64' + pack('<I', len(ds64)) +
+                ds64 + chunks + b'data\xff\xff\xff\xff'), pad
+
+
+def copy_range(src, dst, offset, count):
+    """Appends count bytes of src from offset to dst (file descriptors).
+
+    Uses copy_file_range or sendfile so the data doesn't go through Python,
+    and writes from a memory map where neither works.
+
+    """
+    import os
+    from errno import EXDEV, ENOSYS, EINVAL, EOPNOTSUPP
+    from mmap import mmap, ACCESS_READ
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        if not copy:
+            continue
+        try:
+            while count:
+                if name == 'sendfile':
+                    done = copy(dst, src, offset, count)
+                else:
+                    done = copy(src, dst, count, offset)
+                if not done:
+                    raise EOFError('{0:d} bytes missing'.format(count))
+                offset += done
+                count -= done
+            return
+        except OSError as e:
+            if e.errno not in (EXDEV, ENOSYS, EINVAL, EOPNOTSUPP):
+                raise
+    with mmap(src, 0, access=ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            while count:
+                done = os.write(dst, view[offset:offset + min(count,
+                                                              2 ** 24)])
+                offset += done
+                count -= done
+        finally:
+            view.release()
+
+
+def cut_pcm(wave, trims, output_file, delay=0, merge=True, verbose=False,
+            test=False):
+    """Cuts PCM audio without mkvmerge.
+
+    wave = PCMAudio of the input
+    trims = cut list as made by parse_trims (start, end, ... [start])
+    delay = ns the audio is delayed by; its start is padded with silence
+            when positive and trimmed when negative
+
+    The kept ranges are copied to output_file (or output_file-001.ext, ...
+    for each part if not merge) in the input's format. Returns the number of
+    sample frames written.
+
+    """
+    from os import getpid, replace, unlink, write, close, open as osopen
+    from os import O_WRONLY, O_CREAT, O_TRUNC
+    times = [parse_time(i) for i in trims]
+    if len(times) % 2:
+        times.append(None)
+
+    # (silent frames, first frame, frames) of each part
+    parts = []
+    for start, end in zip(times[::2], times[1::2]):
+        first = round_div((start - delay) * wave.rate, 10 ** 9)
+        last = (round_div((end - delay) * wave.rate, 10 ** 9)
+                if end is not None else wave.frames)
+        last = max(first, min(last, wave.frames))
+        pad = min(max(-first, 0), last - first)
+        parts.append((pad, first + pad, last - first - pad))
+
+    if merge:
+        outputs = [(output_file, parts)]
+    else:
+        root, ext = splitext(output_file)
+        outputs = [('{0}-{1:03d}{2}'.format(root, i + 1, ext), [part])
+                   for i, part in enumerate(parts)]
+    total = sum(i[0] + i[2] for i in parts)
+    if verbose:
+        print('Cutting: "{0}" to {1} ({2:d} Hz, {3:d} frames)\n'.format(
+              wave.path, ', '.join('"{0}"'.format(i[0]) for i in outputs),
+              wave.rate, total))
+    if test:
+        return total
+
+    align = wave.block_align
+    silence = wave.silence * (align * 2 ** 16)
+    with open(wave.path, 'rb') as src:
+        for name, cuts in outputs:
+            size = sum(i[0] + i[2] for i in cuts) * align
+            header, trailer = wave.header(size)
+            tmp = '{0}.{1:d}.tmp'.format(name, getpid())
+            try:
+                dst = osopen(tmp, O_WRONLY | O_CREAT | O_TRUNC, 0o666)
+                try:
+                    write(dst, header)
+                    for pad, first, frames in cuts:
+                        pad *= align
+                        while pad:
+                            pad -= write(dst, silence[:pad])
+                        if frames:
+                            copy_range(src.fileno(), dst, wave.data_offset +
+                                       first * align, frames * align)
+                    write(dst, b'\0' * trailer)
+                finally:
+                    close(dst)
+                replace(tmp, name)
+            except BaseException:
+                if isfile(tmp):
+                    unlink(tmp)
+                raise
+    return total
+
+class CutScheduler(object):
+    """Runs mkvmerge commands in the background, at most `processes` at a
+    time.
+
+    Commands start as soon as they're queued with add(). Their output is
+    streamed as it comes, prefixed by their name if more than one can run at
+    once. join() waits for all of them and returns their exit codes.
+
+    """
+
+    def __init__(self, processes=1):
+        from threading import Thread, Lock
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+        self.processes = processes
+        self.queue = Queue()
+        self.lock = Lock()
+        self.results = []
+        # Tag of the --batch job whose commands are being queued
+        self.job = None
+        self.threads = [Thread(target=self.worker) for i in range(processes)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, cmd, name=None):
+        """Queues a command."""
+        self.queue.put((self.job, cmd, name))
+
+    def worker(self):
+        from subprocess import Popen, PIPE, STDOUT
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            job, cmd, name = item
+            try:
+                proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+                for line in iter(proc.stdout.readline, b''):
+                    self.output(name, line)
+                proc.stdout.close()
+                code = proc.wait()
+            except OSError as e:
+                self.output(name, '{0}\n'.format(e).encode())
+                code = 2
+            with self.lock:
+                self.results.append((job, name, code))
+
+    def output(self, name, line):
+        from sys import stdout
+        line = line.decode('utf-8', 'replace')
+        with self.lock:
+            if self.processes > 1 and name:
+                line = '[{0}] {1}'.format(name, line)
+            stdout.write(line)
+            stdout.flush()
+
+    def join(self):
+        """Waits for every queued command.
+
+        Returns a list of (job, name, exit code) in order of completion.
+
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.results
+
+
+class Profiler(object):
+    """Wall time, CPU time and peak memory of the stages of a run.
+
+    Stages nest (their names are joined by '/') and repeated ones are
+    added up. CPU time includes the child processes waited for, like
+    mkvmerge. Hot functions report their calls through count().
+
+    """
+
+    def __init__(self):
+        import tracemalloc
+        self.tracemalloc = tracemalloc
+        self.stages = {}
+        self.calls = {}
+        self.stack = []
+        self.peak = 0
+        tracemalloc.start()
+        self.start = self.times()
+
+    @staticmethod
+    def times():
+        from os import times
+        from time import perf_counter, process_time
+        t = times()
+        return perf_counter(), process_time() + t[2] + t[3]
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def update_peak(self):
+        """Adds the peak since the last reset to the running stages."""
+        peak = self.tracemalloc.get_traced_memory()[1]
+        self.tracemalloc.reset_peak()
+        self.peak = max(self.peak, peak)
+        for stage in self.stack:
+            stage['peak'] = max(stage['peak'], peak)
+
+    @contextmanager
+    def stage(self, name):
+        self.update_peak()
+        stage = {'name': '/'.join([i['name'] for i in self.stack] + [name]),
+                 'peak': 0}
+        self.stack.append(stage)
+        start = self.times()
+        try:
+            yield
+        finally:
+            end = self.times()
+            self.update_peak()
+            self.stack.pop()
+            total = self.stages.setdefault(stage['name'], {
+                'name': stage['name'], 'calls': 0, 'wall': 0, 'cpu': 0,
+                'peak': 0})
+            total['calls'] += 1
+            total['wall'] += end[0] - start[0]
+            total['cpu'] += end[1] - start[1]
+            total['peak'] = max(total['peak'], stage['peak'])
+
+    def report(self, format='table', file=None):
+        """Writes the stages and call counts as a table or as JSON."""
+        from sys import stderr
+        end = self.times()
+        self.update_peak()
+        self.tracemalloc.stop()
+        file = file or stderr
+        total = {'name': 'total', 'calls': 1, 'wall': end[0] - self.start[0],
+                 'cpu': end[1] - self.start[1], 'peak': self.peak}
+        stages = list(self.stages.values()) + [total]
+        if format == 'json':
+            import json
+            json.dump({'stages': stages, 'calls': self.calls}, file)
+            file.write('\n')
+            return
+        file.write('{0:<36} {1:>6} {2:>10} {3:>10} {4:>10}\n'.format(
+                   'stage', 'calls', 'wall ms', 'cpu ms', 'peak KiB'))
+        for stage in stages:
+            file.write('{0:<36} {1:>6d} {2:>10.2f} {3:>10.2f} {4:>10.1f}\n'
+                       .format(stage['name'], stage['calls'],
+                               stage['wall'] * 1000, stage['cpu'] * 1000,
+                               stage['peak'] / 1024))
+        if self.calls:
+            file.write('\n' + ', '.join('{0}: {1:d}'.format(k, v) for k, v in
+                       sorted(self.calls.items())) + '\n')
+
+
+def stage(name):
+    """Context manager timing a --profile stage (does nothing otherwise)."""
+    return profiler.stage(name) if profiler else nullcontext()
+
+
+def profiled(format, function, *args):
+    """Runs function(*args) under a new Profiler and reports it to stderr."""
+    global profiler
+    profiler = Profiler()
+    try:
+        return function(*args)
+    finally:
+        profiler.report(format)
+        profiler = None
+
 
 if __name__ == '__main__':
+    # Let templates.py share this module (caches, --profile) instead of
+    # importing a second copy of it
+    modules.setdefault('vfr', modules[__name__])
     main(argv[1:])